@@ -80,6 +80,10 @@ class Awsiot(adbase.ADBase, adapi.ADAPI):
 
             **namespace** (optional):  Namespace to use for the call - see the section on namespaces for a detailed description. In most cases it is safe to ignore this parameter. The value ``global`` for namespace has special significance, and means that the callback will lsiten to state updates from any plugin.
 
+            **wildcard** (optional): A MQTT topic filter using the ``+`` and ``#`` wildcards e.g. ``homeassistant/+/light`` or ``homeassistant/#``. The callback will receive messages from all topics matching the filter.
+
+        A message matching several listened wildcards is sent as one event per wildcard, and all but one of them have ``duplicate`` set to ``True``. Callbacks without a ``wildcard`` are only given the events with ``duplicate`` set to ``False``, so they receive each message once.
+
         :return: A handle that can be used to cancel the callback.
         """
 
@@ -87,19 +91,63 @@ class Awsiot(adbase.ADBase, adapi.ADAPI):
 
         if 'wildcard' in kwargs:
             wildcard = kwargs['wildcard']
-            if wildcard[-2:] == '/#' and len(wildcard.split('/')[0]) >= 1:
-                plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
-                utils.run_coroutine_threadsafe(self, plugin.process_awsiot_wildcard(kwargs['wildcard']))
-            else:
+            plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
+            if not utils.run_coroutine_threadsafe(self, plugin.process_awsiot_wildcard(wildcard)):
                 self.logger.warning("Using %s as AWSIoT Wildcard for Event is not valid, use another. Listen Event will not be registered", wildcard)
                 return
+        else:
+            kwargs.setdefault('duplicate', False) # each message once, however many wildcards it matches
 
         return super(Awsiot, self).listen_event(cb, event, **kwargs)
 
+    def awsiot_listen(self, topic_filter, callback, **kwargs):
+
+        """
+        Listens for AWSIoT messages on topics matching a topic filter, with the messages routed directly to the callback.
+
+        Unlike ``listen_event()``, the plugin looks up the callbacks matching each message in a topic trie, so a message is only dispatched to the callbacks it is for, instead of every listener being checked for every message. If the plugin is configured with ``broadcast_events: unrouted``, messages routed to a callback are not also sent as events, and with ``broadcast_events: false`` no message events are sent at all. The topic must still be subscribed to, either in the plugin config or using ``awsiot_subscribe()``.
+
+        :param topic_filter: A MQTT topic filter, which can use the ``+`` and ``#`` wildcards e.g. ``homeassistant/+/light``
+        :param callback: Function to be invoked when a message is received. It must conform to the standard Event Callback format documented `Here <APPGUIDE.html#about-event-callbacks>`__, with the data having the ``topic``, ``payload`` and ``wildcard`` of the message.
+        :param \*\*kwargs: Additional keyword arguments, which are passed to the callback. Also:
+
+            **namespace** (optional): Namespace to use for the call - see the section on namespaces for a detailed description. In most cases it is safe to ignore this parameter.
+
+        :return: A handle that can be used to cancel the callback using ``awsiot_cancel_listen()``.
+
+        **Examples**:
+
+        >>> self.awsiot_listen("homeassistant/+/light", self.light_message)
+        """
+
+        namespace = self._get_namespace(**kwargs)
+        kwargs.pop('namespace', None)
+        plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
+        handle = utils.run_coroutine_threadsafe(self, plugin.add_awsiot_listener(self.name, topic_filter, callback, kwargs))
+
+        if handle is None:
+            self.logger.warning("Using %s as AWSIoT Topic Filter is not valid, use another. Listener will not be registered", topic_filter)
+
+        return handle
+
+    def awsiot_cancel_listen(self, handle, **kwargs):
+
+        """
+        Cancels a callback registered using ``awsiot_listen()``.
+
+        :param handle: The handle returned when the callback was registered
+        :return: ``True`` if the callback was cancelled, ``False`` if it did not exist.
+        """
+
+        namespace = self._get_namespace(**kwargs)
+        plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
+        return utils.run_coroutine_threadsafe(self, plugin.cancel_awsiot_listener(handle))
+
     #
     # service calls
     #
-    def awsiot_publish(self, topic, payload = None, **kwargs):
+    @utils.sync_wrapper
+    async def awsiot_publish(self, topic, payload = None, **kwargs):
         """
         A helper function used for publishing a AWSIoT message to a broker, from within an AppDaemon app.
 
@@ -113,8 +161,14 @@ class Awsiot(adbase.ADBase, adapi.ADAPI):
 
             **retain**: This flag is used to specify if the broker is to retain the payload or not. This defaults to ``False``.
 
+            **lane**: The publish lane to use, when the plugin is configured with ``publish_rate``. Lanes with a higher priority are published first, e.g. for alarms ahead of telemetry. This defaults to the ``default_lane`` of the plugin.
+
+            **callback**: A function to be called with the result of the publish, once it has been acknowledged by the broker. When given, the call returns immediately without waiting for the acknowledgement. The signature of this function follows that of a scheduler call.
+
             **namespace**: Namespace to use for the service - see the section on namespaces for a detailed description. In most cases it is safe to ignore this parameter
 
+        :return: ``True`` if the publish was successful. If the plugin is configured with ``pipelined_publish``, this is once the broker has acknowledged it.
+
         **Examples**:
 
         >>> self.awsiot_publish("homeassistant/bedroom/light", "ON")
@@ -125,7 +179,13 @@ class Awsiot(adbase.ADBase, adapi.ADAPI):
         kwargs['topic'] = topic
         kwargs['payload'] = payload
         service = 'awsiot/publish'
-        result = self.call_service(service, **kwargs)
+        callback = kwargs.pop('callback', None)
+
+        if callback is not None and callable(callback):
+            self.create_task(self.call_service(service, **kwargs), callback)
+            return None
+
+        result = await self.call_service(service, **kwargs)
         return result
 
     def awsiot_subscribe(self, topic, **kwargs):
@@ -158,6 +218,87 @@ class Awsiot(adbase.ADBase, adapi.ADAPI):
         result = self.call_service(service, **kwargs)
         return result
 
+    def shadow_get(self, thing, **kwargs):
+
+        """
+        A helper function used for requesting the current shadow document of a thing from AWS IoT, from within an AppDaemon app.
+
+        The received document is stored in the plugin's local shadow cache, and also as a ``shadow.<thing>`` entity in the plugin's namespace, with the shadow's version as its state. Shadows declared in the ``shadows`` plugin config are requested at startup, so it is usually better to use ``get_shadow()`` which reads from memory.
+
+        :param thing: The name of the thing whose shadow is requested
+        :return: The shadow as a dictionary with ``version``, ``reported``, ``desired`` and ``delta``, or ``None`` if the request was not accepted.
+        """
+
+        kwargs['thing'] = thing
+        service = 'awsiot/shadow_get'
+        result = self.call_service(service, **kwargs)
+        return result
+
+    def shadow_update(self, thing, reported = None, desired = None, **kwargs):
+
+        """
+        A helper function used for updating the shadow of a thing on AWS IoT, from within an AppDaemon app.
+
+        The given state is compared with the local shadow cache, and only the keys that changed are sent. Setting a key to ``None`` deletes it from the shadow.
+
+        :param thing: The name of the thing whose shadow is to be updated
+        :param reported: The reported state of the thing e.g. ``{"light": "on"}``
+        :param desired: The desired state of the thing e.g. ``{"light": "off"}``
+        :return: ``True`` if the update was accepted or nothing changed, ``False`` otherwise.
+
+        **Examples**:
+
+        >>> self.shadow_update("bedroom_light", reported = {"light": "on", "brightness": 80})
+        """
+
+        kwargs['thing'] = thing
+        kwargs['reported'] = reported
+        kwargs['desired'] = desired
+        service = 'awsiot/shadow_update'
+        result = self.call_service(service, **kwargs)
+        return result
+
+    def shadow_delete(self, thing, **kwargs):
+
+        """
+        A helper function used for deleting the shadow of a thing on AWS IoT, from within an AppDaemon app.
+
+        :param thing: The name of the thing whose shadow is to be deleted
+        """
+
+        kwargs['thing'] = thing
+        service = 'awsiot/shadow_delete'
+        result = self.call_service(service, **kwargs)
+        return result
+
+    def get_shadow(self, thing, **kwargs):
+
+        """
+        Gets the shadow of a thing from the plugin's local shadow cache, without a round trip to AWS IoT.
+
+        :param thing: The name of the thing whose shadow is requested
+        :return: The shadow as a dictionary with ``version``, ``reported``, ``desired`` and ``delta``, or ``None`` if the shadow is not managed by the plugin.
+        """
+
+        namespace = self._get_namespace(**kwargs)
+        plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
+        return utils.run_coroutine_threadsafe(self, plugin.get_shadow(thing))
+
+    def get_last_value(self, topic, **kwargs):
+
+        """
+        Gets the last payload received on a topic from the plugin's last value cache, without waiting for the next publish.
+
+        Only topics matching the plugin's ``state_topics`` are cached, and each is also kept as a ``topic.`` entity in the plugin's namespace.
+
+        :param topic: The topic whose last payload is requested
+        :return: The decoded payload, or ``None`` if nothing was received on the topic or it is not cached.
+        """
+
+        namespace = self._get_namespace(**kwargs)
+        plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
+        return utils.run_coroutine_threadsafe(self, plugin.get_last_value(topic))
+
     def clientConnected(self, **kwargs):
         namespace = self._get_namespace(**kwargs)
         plugin = utils.run_coroutine_threadsafe(self, self.AD.plugins.get_plugin_object(namespace))
@@ -1,13 +1,514 @@
 import copy
+import collections
+import functools
+import os
+import re
+import struct
+import threading
+import uuid
+import zlib
 import AWSIoTPythonSDK.MQTTLib as AWSIoTPyMQTT
 from AWSIoTPythonSDK.exception import AWSIoTExceptions
 import asyncio
+import bisect
+import json
+import time
 import traceback
 
+try:
+    import orjson # fast parser, if available
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    try:
+        import ujson
+        json_loads = ujson.loads
+        json_dumps = ujson.dumps
+    except ImportError:
+        json_loads = json.loads
+        json_dumps = json.dumps
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
 import appdaemon.utils as utils
 from appdaemon.appdaemon import AppDaemon
 from appdaemon.plugin_management import PluginBase
 
+SHADOW_TOPIC = '$aws/things/{}/shadow/'
+
+def to_bytes(payload):
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return payload
+    if isinstance(payload, str):
+        return payload.encode()
+    return str(payload).encode()
+
+def json_encode(payload):
+    if isinstance(payload, (str, bytes, bytearray)): # already serialized
+        return to_bytes(payload)
+    return to_bytes(json_dumps(payload))
+
+# payload codecs as (encode, decode), which can be chained like json+zlib
+PAYLOAD_CODECS = {
+    'bytes': (to_bytes, lambda x: x),
+    'text': (to_bytes, lambda x: bytes(x).decode()),
+    'json': (json_encode, json_loads),
+    'zlib': (lambda x: zlib.compress(to_bytes(x)), zlib.decompress),
+    'deflate': (lambda x: zlib.compress(to_bytes(x))[2:-4], lambda x: zlib.decompress(x, -15)),
+}
+
+if msgpack is not None:
+    PAYLOAD_CODECS['msgpack'] = (lambda x: msgpack.packb(x, use_bin_type=True), lambda x: msgpack.unpackb(x, raw=False))
+
+if cbor2 is not None:
+    PAYLOAD_CODECS['cbor'] = (cbor2.dumps, cbor2.loads)
+
+def parse_codecs(name):
+    """Returns the codecs of a chain like json+zlib, or None if any is not available"""
+    codecs = name.split('+') if isinstance(name, str) else []
+    if codecs == [] or any(x not in PAYLOAD_CODECS for x in codecs):
+        return None
+    return codecs
+
+def codec_encode(codecs, payload):
+    for codec in codecs:
+        payload = PAYLOAD_CODECS[codec][0](payload)
+    return payload
+
+def codec_decode(codecs, payload):
+    for codec in reversed(codecs):
+        payload = PAYLOAD_CODECS[codec][1](payload)
+    return payload
+
+def shadow_diff(new, old):
+    """Returns the keys of new, whose values are not the same in old"""
+    diff = {}
+    for key, value in new.items():
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            changed = shadow_diff(value, old[key])
+            if changed != {}:
+                diff[key] = changed
+
+        elif key not in old or old[key] != value:
+            diff[key] = value
+
+    return diff
+
+def shadow_merge(target, update):
+    """Applies a partial shadow state to target, where a value of None deletes the key"""
+    for key, value in update.items():
+        if value is None:
+            target.pop(key, None)
+
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            shadow_merge(target[key], value)
+
+        else:
+            target[key] = copy.deepcopy(value)
+
+    return target
+
+class Outbox:
+    """Durable queue of publishes, held in append-only segment files.
+
+    Each record is a header of the topic length, payload length and QoS, followed by the
+    topic and payload. Records are read from a cursor which is persisted after each commit,
+    so publishes are delivered at least once and in order across restarts. Each append is
+    fsynced unless fsync is off, and a record cut short by a crash is truncated on start.
+    """
+
+    HEADER = struct.Struct('>HIB')
+
+    def __init__(self, path, segment_size = 1048576, max_size = 104857600, drop_policy = 'oldest', fsync = True):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.drop_policy = drop_policy
+        self.fsync = fsync
+        self.dropped = 0
+        self.truncated = 0
+        self.lock = threading.RLock() # append holds it while checking the size
+
+        os.makedirs(path, exist_ok = True)
+        self.segments = sorted(int(x[:-4]) for x in os.listdir(path) if x.endswith('.seg'))
+        self.sizes = {}
+        for segment in self.segments:
+            with open(self.segment_file(segment), 'rb') as f:
+                data = f.read()
+            size = self.complete_size(data)
+            if size < len(data): # an append was interrupted, so the partial record is dropped
+                with open(self.segment_file(segment), 'r+b') as f:
+                    f.truncate(size)
+                self.truncated += 1
+            self.sizes[segment] = size
+
+        self.cursor = (self.segments[0] if self.segments != [] else 0, 0)
+        try:
+            with open(os.path.join(path, 'cursor'), 'r') as f:
+                segment, offset = (int(x) for x in f.read().split())
+            if segment in self.sizes:
+                self.cursor = (segment, offset)
+        except (OSError, ValueError):
+            pass
+
+    def segment_file(self, segment):
+        return os.path.join(self.path, '{:010d}.seg'.format(segment))
+
+    def record_size(self, data, offset):
+        """Returns the size of the record at offset, or 0 if it is cut short"""
+        if len(data) - offset < self.HEADER.size:
+            return 0
+        topic_len, payload_len, _ = self.HEADER.unpack_from(data, offset)
+        size = self.HEADER.size + topic_len + payload_len
+        return size if offset + size <= len(data) else 0
+
+    def complete_size(self, data):
+        offset = 0
+        while offset < len(data):
+            size = self.record_size(data, offset)
+            if size == 0:
+                break
+            offset += size
+        return offset
+
+    def size(self):
+        with self.lock:
+            return sum(self.sizes.values())
+
+    def pending(self):
+        with self.lock:
+            segment, offset = self.cursor
+            return sum(size for x, size in self.sizes.items() if x > segment) + self.sizes.get(segment, 0) - offset
+
+    def append(self, topic, payload, qos):
+        if payload is None:
+            payload = b''
+        elif isinstance(payload, str):
+            payload = payload.encode()
+        elif not isinstance(payload, (bytes, bytearray)):
+            payload = str(payload).encode()
+
+        topic = topic.encode()
+        record = self.HEADER.pack(len(topic), len(payload), qos) + topic + payload
+
+        with self.lock:
+            while self.size() + len(record) > self.max_size:
+                # the segment being written to cannot be dropped
+                if self.drop_policy == 'newest' or len(self.segments) < 2:
+                    self.dropped += 1
+                    return False
+                self.drop_segment(self.segments[0])
+
+            if self.segments == [] or self.sizes[self.segments[-1]] >= self.segment_size:
+                segment = self.segments[-1] + 1 if self.segments != [] else self.cursor[0]
+                self.segments.append(segment)
+                self.sizes[segment] = 0
+
+            segment = self.segments[-1]
+            with open(self.segment_file(segment), 'ab') as f:
+                f.write(record)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            self.sizes[segment] += len(record)
+
+        return True
+
+    def drop_segment(self, segment):
+        records = 0
+        with open(self.segment_file(segment), 'rb') as f:
+            data = f.read()
+        offset = self.cursor[1] if self.cursor[0] == segment else 0
+        while offset < len(data):
+            size = self.record_size(data, offset)
+            if size == 0:
+                break
+            offset += size
+            records += 1
+
+        self.dropped += records
+        self.remove_segment(segment)
+
+    def remove_segment(self, segment):
+        os.remove(self.segment_file(segment))
+        self.segments.remove(segment)
+        del self.sizes[segment]
+
+        if self.cursor[0] == segment:
+            self.cursor = (self.segments[0] if self.segments != [] else segment + 1, 0)
+
+    def read(self, count):
+        """Returns up to count records from the cursor, each with the position to commit once it is sent"""
+
+        records = []
+        with self.lock:
+            segment, offset = self.cursor
+            for x in [y for y in self.segments if y >= segment]:
+                if x != segment:
+                    segment, offset = x, 0
+
+                with open(self.segment_file(segment), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+
+                position = 0
+                while position < len(data) and len(records) < count:
+                    if self.record_size(data, position) == 0:
+                        break # cut short, which only a failed write leaves behind
+                    topic_len, payload_len, qos = self.HEADER.unpack_from(data, position)
+                    position += self.HEADER.size
+                    topic = data[position:position + topic_len].decode()
+                    position += topic_len
+                    position += payload_len
+                    records.append((topic, data[position - payload_len:position], qos, (segment, offset + position)))
+
+                if len(records) >= count:
+                    break
+
+        return records
+
+    def commit(self, position):
+        with self.lock:
+            segment, offset = position
+            # fully sent segments are removed, unless still being written to
+            for x in [y for y in self.segments if y < segment or (y == segment and offset >= self.sizes[y] and y != self.segments[-1])]:
+                self.remove_segment(x)
+
+            if segment in self.sizes:
+                self.cursor = (segment, offset)
+
+            with open(os.path.join(self.path, 'cursor.tmp'), 'w') as f:
+                f.write('{} {}'.format(*self.cursor))
+            os.replace(os.path.join(self.path, 'cursor.tmp'), os.path.join(self.path, 'cursor'))
+
+class TokenBucket:
+    """Allows up to rate operations per second, with bursts of up to burst operations"""
+
+    def __init__(self, rate, burst):
+        if rate <= 0:
+            raise ValueError("rate must be above 0")
+        self.rate = rate
+        self.burst = max(1, burst) # else a token can never be taken, when the rate is below 1 per second
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """Takes a token, returning 0 if it was taken or else the seconds to wait for one"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+class LatencyHistogram:
+    """Fixed bucket histogram of latencies in seconds, with approximate percentiles"""
+
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile"""
+        if self.count == 0:
+            return None
+
+        target = self.count * percent / 100
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+
+        return self.max
+
+    def summary(self):
+        """Returns the histogram in milliseconds"""
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
+
+        return {
+            "count": self.count,
+            "mean": ms(self.total / self.count) if self.count > 0 else None,
+            "p50": ms(self.percentile(50)),
+            "p90": ms(self.percentile(90)),
+            "p99": ms(self.percentile(99)),
+            "max": ms(self.max),
+            "unit_of_measurement": "ms"
+        }
+
+class TopicNode:
+    __slots__ = ('children', 'filter', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.filter = None
+        self.values = []
+
+class TopicTrie:
+    """Matches MQTT topics against topic filters, supporting the ``+`` and ``#`` wildcards.
+
+    Matching walks the trie level by level, so its cost depends on the depth of the topic
+    and not on the number of filters. Results are kept in a bounded cache of topic to filters.
+    """
+
+    def __init__(self, cache_size=1024):
+        self.root = TopicNode()
+        self.nodes = {}
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    @staticmethod
+    def valid_filter(topic_filter):
+        if not isinstance(topic_filter, str) or topic_filter == '':
+            return False
+
+        levels = topic_filter.split('/')
+        for i, level in enumerate(levels):
+            if '#' in level and (level != '#' or i != len(levels) - 1):
+                return False
+
+            if '+' in level and level != '+':
+                return False
+
+        return True
+
+    @staticmethod
+    def specificity(topic_filter):
+        """Sort key of filters, where more literal levels, then no #, then more levels is more specific"""
+        levels = topic_filter.split('/')
+        return (len([x for x in levels if x not in ('+', '#')]), levels[-1] != '#', len(levels))
+
+    @staticmethod
+    def has_wildcard(topic_filter):
+        return '+' in topic_filter or '#' in topic_filter
+
+    def add(self, topic_filter, value=None):
+        node = self.root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicNode()
+            node = child
+
+        node.filter = topic_filter
+        if value is not None and value not in node.values:
+            node.values.append(value)
+
+        self.nodes[topic_filter] = node
+        self.cache.clear()
+
+    def remove(self, topic_filter, value=None):
+        node = self.nodes.get(topic_filter)
+        if node is None:
+            return False
+
+        if value is not None:
+            if value in node.values:
+                node.values.remove(value)
+
+            if node.values != []: # still used by others
+                self.cache.clear()
+                return True
+
+        node.filter = None
+        node.values = []
+        del self.nodes[topic_filter]
+
+        # prune the branch if nothing else hangs from it
+        path = [self.root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            path.append(path[-1].children[level])
+
+        for i in range(len(levels), 0, -1):
+            child = path[i]
+            if child.filter is not None or child.children != {}:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+        self.cache.clear()
+        return True
+
+    def get(self, topic_filter):
+        node = self.nodes.get(topic_filter)
+        return node.values if node is not None else []
+
+    def __contains__(self, topic_filter):
+        return topic_filter in self.nodes
+
+    def match(self, topic):
+        try:
+            matches = self.cache[topic]
+            self.cache.move_to_end(topic)
+            return matches
+        except KeyError:
+            pass
+
+        matches = []
+        self._match(self.root, topic.split('/'), 0, matches, topic.startswith('$'))
+        matches = tuple(matches)
+
+        self.cache[topic] = matches
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return matches
+
+    def _match(self, node, levels, index, matches, system):
+        # wildcards at the first level do not match topics starting with $, as per the MQTT spec
+        wildcards = index > 0 or not system
+
+        if index == len(levels):
+            if node.filter is not None:
+                matches.append(node.filter)
+
+            child = node.children.get('#') # "a/#" also matches "a"
+            if child is not None and child.filter is not None:
+                matches.append(child.filter)
+            return
+
+        if wildcards:
+            child = node.children.get('#')
+            if child is not None and child.filter is not None:
+                matches.append(child.filter)
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, matches, system)
+
+        if wildcards:
+            child = node.children.get('+')
+            if child is not None:
+                self._match(child, levels, index + 1, matches, system)
+
 class AwsiotPlugin(PluginBase):
 
     def __init__(self, ad: AppDaemon, name, args):
@@ -53,6 +554,41 @@ class AwsiotPlugin(PluginBase):
         self.offlinePublishing = self.config.get('offlinePublishing', -1)
         self.operationalTimeout = self.config.get('operationalTimeout', 5)
         self.drainingFrequency = self.config.get('drainingFrequency', 2)
+        self.awsiot_ingress_batch = self.config.get('ingress_batch_size', 100)
+        self.awsiot_metrics_interval = self.config.get('metrics_interval', 60)
+        self.awsiot_metrics = {'received': 0, 'dispatched': 0, 'published': 0, 'publish_failures': 0,
+                               'connects': 0, 'disconnects': 0, 'ingress_max_depth': 0}
+        self.awsiot_ingress_latency = LatencyHistogram()
+        self.awsiot_publish_latency = LatencyHistogram()
+        self.awsiot_outbox = None
+        self.awsiot_outbox_config = self.config.get('outbox')
+
+        if isinstance(self.awsiot_outbox_config, dict):
+            if self.awsiot_outbox_config.get('path') is None:
+                self.logger.critical("Please provide a path for the AWSIoT outbox, as it will not be used")
+            else:
+                self.awsiot_outbox = Outbox(self.awsiot_outbox_config['path'],
+                                            int(self.awsiot_outbox_config.get('segment_size', 1048576)),
+                                            int(self.awsiot_outbox_config.get('max_size', 104857600)),
+                                            self.awsiot_outbox_config.get('drop_policy', 'oldest'),
+                                            self.awsiot_outbox_config.get('fsync', True))
+                if self.awsiot_outbox.truncated > 0:
+                    self.logger.warning("Truncated %s incomplete records in the AWSIoT outbox, left by an interrupted write", self.awsiot_outbox.truncated)
+                self.offlinePublishing = 0 # the outbox queues the publishes instead of the SDK
+        self.awsiot_payload_format = parse_codecs(self.config.get('payload_format', 'text'))
+        if self.awsiot_payload_format is None:
+            self.logger.warning("Payload format %r is not valid, so using text", self.config.get('payload_format'))
+            self.awsiot_payload_format = ['text']
+        self.awsiot_payload_formats = self.config.get('payload_formats', {})
+        self.awsiot_pipelined = self.config.get('pipelined_publish', False)
+        self.awsiot_publish_window = self.config.get('publish_window', 20)
+        self.awsiot_publish_rate = self.config.get('publish_rate') # publishes per second, when limited
+        self.awsiot_publish_lanes = []
+        self.awsiot_default_lane = self.config.get('default_lane', 'default')
+        self.awsiot_shadows = {} # local cache of the device shadows
+        self.awsiot_shadow_requests = {}
+        self.awsiot_listeners = {} # callbacks routed to directly, by topic filter
+        self.awsiot_broadcast = self.config.get('broadcast_events', True)
 
         status_topic = '{}/status'.format(self.config.get('client_id', self.name + ' client').lower())
         
@@ -81,15 +617,101 @@ class AwsiotPlugin(PluginBase):
             awsiot_id = 'ad_aws_{}_client'.format(self.name.lower())
             self.logger.info("Using %s as Client ID", awsiot_id)
 
-        self.awsiot = AWSIoTPyMQTT.AWSIoTMQTTClient(awsiot_id, useWebsocket=awsiot_useWebsockets)
+        # subscriptions and publishes are sharded across the connections by topic
+        self.awsiot_connections = max(int(self.config.get('client_connections', 1)), 1)
+        self.awsiot_clients = []
+        self.awsiot_clients_online = set()
 
-        self.awsiot.onOnline = self.awsiot_onOnline
-        self.awsiot.onOffline = self.awsiot_onOffline
-        #self.awsiot.on_message = self.awsiot_on_message
+        for index in range(self.awsiot_connections):
+            client_id = awsiot_id if index == 0 else '{}_{}'.format(awsiot_id, index)
+            client = AWSIoTPyMQTT.AWSIoTMQTTClient(client_id, useWebsocket=awsiot_useWebsockets)
+            client.onOnline = functools.partial(self.awsiot_onOnline, index)
+            client.onOffline = functools.partial(self.awsiot_onOffline, index)
+            self.awsiot_clients.append(client)
+
+        self.awsiot = self.awsiot_clients[0] # used for the birth, will and shutdown messages
 
         self.loop = self.AD.loop # get AD loop
         self.awsiot_connect_event = asyncio.Event(loop = self.loop)
-        self.awsiot_wildcards = list()
+        self.awsiot_disconnect_event = asyncio.Event(loop = self.loop)
+        self.awsiot_resubscribe = self.config.get('resubscribe_on_reconnect', True)
+        self.awsiot_ingress = collections.deque() # filled from the SDK's thread, drained in the loop
+        self.awsiot_ingress_event = asyncio.Event(loop = self.loop)
+        self.awsiot_ingress_scheduled = False
+        self.awsiot_ingress_task = None
+        self.awsiot_outbox_task = None
+        self.awsiot_metrics_task = None
+        self.awsiot_scheduler_task = None
+        self.awsiot_scheduler_event = asyncio.Event(loop = self.loop)
+
+        if self.awsiot_publish_rate is not None and float(self.awsiot_publish_rate) <= 0:
+            self.logger.warning("Publish rate %r is not valid, and so will be ignored", self.awsiot_publish_rate)
+            self.awsiot_publish_rate = None
+
+        if self.awsiot_publish_rate is not None:
+            self.awsiot_bucket = TokenBucket(float(self.awsiot_publish_rate), float(self.config.get('publish_burst', self.awsiot_publish_rate)))
+            lanes = self.config.get('publish_lanes', {})
+            lanes.setdefault(self.awsiot_default_lane, {'priority': 100})
+
+            # lanes are served in order of priority, lower first
+            for lane, settings in lanes.items():
+                self.awsiot_publish_lanes.append({
+                    'name': lane,
+                    'priority': int(settings.get('priority', 100)),
+                    'max_queue': int(settings.get('max_queue', 1000)),
+                    'drop_policy': settings.get('drop_policy', 'oldest'),
+                    'queue': collections.deque(),
+                    'dropped': 0
+                })
+            self.awsiot_publish_lanes.sort(key = lambda x: x['priority'])
+
+        self.awsiot_publish_slots = [asyncio.Semaphore(self.awsiot_publish_window, loop = self.loop) for _ in range(self.awsiot_connections)] # in-flight publishes, per connection
+        self.awsiot_trie = TopicTrie(self.config.get('wildcard_cache_size', 1024))
+        for topic in self.awsiot_topics:
+            self.awsiot_trie.add(topic, 'subscription')
+
+        for thing in self.config.get('shadows', []):
+            self.awsiot_shadow_add(thing)
+
+        # opt-in last value cache, with the topics matching state_topics kept as entities
+        self.awsiot_state_trie = TopicTrie(self.config.get('wildcard_cache_size', 1024))
+        self.awsiot_state_cache_size = int(self.config.get('state_cache_size', 1000))
+        self.awsiot_last_values = {} # raw payload and entity per cached topic, so entities are only updated on change
+        self.awsiot_state_entities = {} # topic per entity, so two topics never share an entity
+        self.awsiot_state_cache_warned = False
+        state_topics = self.config.get('state_topics', {})
+        if isinstance(state_topics, list):
+            state_topics = {x: {} for x in state_topics}
+        for index, (topic, settings) in enumerate(state_topics.items()):
+            settings = settings or {}
+            if not TopicTrie.valid_filter(topic):
+                self.logger.warning("State Topic %r is not valid, and so will be ignored", topic)
+                continue
+            self.awsiot_state_trie.add(topic, (index, settings.get('state_key')))
+            if self.awsiot_trie.match(topic) == (): # not covered by the subscriptions
+                self.awsiot_topics.append(topic)
+                self.awsiot_trie.add(topic, 'subscription')
+        self.awsiot_state_topics = len(state_topics) > 0
+
+        self.awsiot_routes = TopicTrie(self.config.get('wildcard_cache_size', 1024))
+        self.awsiot_payload_trie = TopicTrie(self.config.get('wildcard_cache_size', 1024))
+        for index, (topic, payload_format) in enumerate(self.awsiot_payload_formats.items()):
+            codecs = parse_codecs(payload_format)
+            if codecs is None or not TopicTrie.valid_filter(topic):
+                self.logger.warning("Payload format %r for Topic %r is not valid or not installed, and so will be ignored", payload_format, topic)
+                continue
+            self.awsiot_payload_trie.add(topic, (index, codecs)) # earlier entries take precedence
+
+        self.awsiot_coalesce_trie = TopicTrie(self.config.get('wildcard_cache_size', 1024))
+        self.awsiot_coalesced = {} # per topic state of the coalesced messages
+        for index, (topic, settings) in enumerate(self.config.get('coalesce', {}).items()):
+            mode = settings.get('mode', 'last_value')
+            interval = float(settings.get('interval', 1))
+            if mode not in ('last_value', 'min_interval') or interval <= 0 or not TopicTrie.valid_filter(topic):
+                self.logger.warning("Coalesce settings %r for Topic %r is not valid, and so will be ignored", settings, topic)
+                continue
+            self.awsiot_coalesce_trie.add(topic, (index, mode, interval))
+
         self.awsiot_metadata = {
             "version": "1.0",
             "endpoint" : self.awsiot_endpoint,
@@ -115,80 +737,317 @@ class AwsiotPlugin(PluginBase):
             "client_key" : self.awsiot_client_key,
             "timeout" : self.awsiot_timeout,
             "operationalTimeout" : self.operationalTimeout,
-            "offlinePublishing" : self.offlinePublishing
+            "offlinePublishing" : self.offlinePublishing,
+            "client_connections" : self.awsiot_connections
                             }
 
     def stop(self):
         self.logger.debug("stop() called for %s", self.name)
         self.stopping = True
-        if self.awsiot_connected:
+        self.loop.call_soon_threadsafe(self.awsiot_ingress_event.set) # wake up the consumer so it exits
+        self.loop.call_soon_threadsafe(self.awsiot_disconnect_event.set) # and the supervisor
+        online = sorted(self.awsiot_clients_online) # each connection still up is closed, even if others are down
+        if online != []:
             self.logger.info("Stopping AWSIoT Plugin and Unsubcribing from URL %s:%s", self.awsiot_endpoint, self.awsiot_port)
             for topic in self.awsiot_topics:
+                if self.awsiot_client_index(topic) not in online:
+                    continue
                 self.logger.debug("Unsubscribing from Topic: %s", topic)
                 try:
-                    result = self.awsiot.unsubscribe(topic)
+                    result = self.awsiot_client(topic).unsubscribe(topic)
                     if result:
                         self.logger.debug("Unsubscription from Topic %r Successful", topic)
                 except AWSIoTExceptions.unsubscribeTimeoutException as au:
                     self.logger.critical("There was an Unsubscription error %r, while trying to Unsubscribe from Topic %s", au, topic)
                     self.logger.debug("There was an Unsubscription error %r, while trying to Unsubscribe from Topic %s with Traceback: %s", au, topic, traceback.format_exc())
-        
-            try:                    
-                self.awsiot.publish(self.awsiot_will_topic, self.awsiot_shutdown_payload, self.awsiot_qos)
-                self.awsiot.disconnect() #disconnect cleanly
-            except AWSIoTExceptions.disconnectError as ad:
-                self.logger.critical("There was a Disconnection error %r, while trying to stop the AWSIoT Service", ad)
-                self.logger.debug("There was a Disconnection error %r, while trying to stop the AWSIoT Service with Traceback: %s", ad, traceback.format_exc())
-            except AWSIoTExceptions.disconnectTimeoutException:
-                self.logger.critical("There was a Time Out Disconnection error while trying to stop the AWSIoT Service")
-                self.logger.debug("There was a Time Out Disconnection error while trying to stop the AWSIoT Service with Traceback: %s", traceback.format_exc())
-
-    def awsiot_onOnline(self):
-        self.awsiot_connected = True
 
-        self.awsiot.publish(self.awsiot_onOnline_topic, self.awsiot_onOnline_payload, self.awsiot_qos)
+            if 0 in online: # the shutdown payload is sent on the connection holding the last will
+                try:
+                    self.awsiot.publish(self.awsiot_will_topic, self.awsiot_shutdown_payload, self.awsiot_qos)
+                except AWSIoTExceptions.publishTimeoutException:
+                    self.logger.critical("There was a Time Out error while trying to publish the Shutdown Payload")
+                    self.logger.debug("There was a Time Out error while trying to publish the Shutdown Payload with Traceback: %s", traceback.format_exc())
+
+            for index in online:
+                try:
+                    self.awsiot_clients[index].disconnect() #disconnect cleanly
+                except AWSIoTExceptions.disconnectError as ad:
+                    self.logger.critical("There was a Disconnection error %r, while trying to stop the AWSIoT Service", ad)
+                    self.logger.debug("There was a Disconnection error %r, while trying to stop the AWSIoT Service with Traceback: %s", ad, traceback.format_exc())
+                except AWSIoTExceptions.disconnectTimeoutException:
+                    self.logger.critical("There was a Time Out Disconnection error while trying to stop the AWSIoT Service")
+                    self.logger.debug("There was a Time Out Disconnection error while trying to stop the AWSIoT Service with Traceback: %s", traceback.format_exc())
+
+    def awsiot_onOnline(self, index = 0):
+        self.awsiot_clients_online.add(index)
+
+        if index == 0:
+            self.awsiot.publish(self.awsiot_onOnline_topic, self.awsiot_onOnline_payload, self.awsiot_qos)
 
-        self.logger.info("Connected to Endpoint at URL %s:%s", self.awsiot_endpoint, self.awsiot_port)
-        #
-        # Register AWSIoT Services
-        #
-        self.AD.services.register_service(self.namespace, "awsiot", "subscribe", self.call_plugin_service)
-        self.AD.services.register_service(self.namespace, "awsiot", "unsubscribe", self.call_plugin_service)
-        self.AD.services.register_service(self.namespace, "awsiot", "publish", self.call_plugin_service)
+        self.logger.info("Connection %s Connected to Endpoint at URL %s:%s", index, self.awsiot_endpoint, self.awsiot_port)
+
+        if len(self.awsiot_clients_online) < self.awsiot_connections or self.awsiot_connected:
+            return # wait for all connections
+
+        self.awsiot_connected = True
+        self.awsiot_ingress_put(('state', None, 'Connected', time.monotonic()))
 
-        data = {'event_type': self.awsiot_event_name, 'data': {'state': 'Connected', 'topic' : None, 'wildcard' : None}}
-        self.loop.create_task(self.send_ad_event(data))
+        self.loop.call_soon_threadsafe(self.awsiot_connection_changed, True) # let the supervisor know
 
-        self.awsiot_connect_event.set() # continue processing
+    def awsiot_onOffline(self, index = 0):
+        self.awsiot_clients_online.discard(index)
 
-    def awsiot_onOffline(self):
         if not self.stopping: #unexpected disconnection
+            self.logger.critical("AWSIoT Client Connection %s Disconnected Abruptly. Will attempt reconnection", index)
+
+            if not self.awsiot_connected:
+                return
+
             self.awsiot_connected = False
-            self.logger.critical("AWSIoT Client Disconnected Abruptly. Will attempt reconnection")
+            self.awsiot_ingress_put(('state', None, 'Disconnected', time.monotonic()))
+
+            self.loop.call_soon_threadsafe(self.awsiot_connection_changed, False)
+
+    def awsiot_connection_changed(self, connected):
+        # counted here, so the metrics are about the plugin as a whole and not each connection
+        if connected:
+            self.awsiot_metrics['connects'] += 1
+            self.awsiot_disconnect_event.clear()
+            self.awsiot_connect_event.set()
+        else:
+            self.awsiot_metrics['disconnects'] += 1
+            self.awsiot_connect_event.clear()
+            self.awsiot_disconnect_event.set()
+
+    def awsiot_client_index(self, topic):
+        # stable across restarts, so a topic always uses the same connection and its order is kept
+        return zlib.crc32(topic.encode()) % self.awsiot_connections
 
-            data = {'event_type': self.awsiot_event_name, 'data': {'state': 'Disconnected', 'topic' : None, 'wildcard' : None}}
-            self.loop.create_task(self.send_ad_event(data))
+    def awsiot_client(self, topic):
+        return self.awsiot_clients[self.awsiot_client_index(topic)]
 
     def awsiot_on_message(self, client, userdata, msg):
-        try:
-            self.logger.debug("Message Received: Topic = %s, Payload = %s", msg.topic, msg.payload)
-            topic = msg.topic
+        # runs on the SDK's thread, so the message is only handed over to the loop here
+        self.awsiot_ingress_put(('message', msg.topic, msg.payload, time.monotonic()))
+
+    def awsiot_ingress_put(self, item):
+        self.awsiot_ingress.append(item)
+
+        if not self.awsiot_ingress_scheduled: # only wake up the consumer once per batch
+            self.awsiot_ingress_scheduled = True
+            self.loop.call_soon_threadsafe(self.awsiot_ingress_event.set)
+
+    async def awsiot_ingress_consumer(self):
+        while not self.stopping:
+            await self.awsiot_ingress_event.wait()
+            self.awsiot_ingress_event.clear()
+            self.awsiot_ingress_scheduled = False # must be reset before draining, so no wakeup is lost
+
+            if len(self.awsiot_ingress) > self.awsiot_metrics['ingress_max_depth']:
+                self.awsiot_metrics['ingress_max_depth'] = len(self.awsiot_ingress)
+
+            while self.awsiot_ingress and not self.stopping:
+                for _ in range(min(self.awsiot_ingress_batch, len(self.awsiot_ingress))):
+                    kind, topic, payload, received = self.awsiot_ingress.popleft()
+                    try:
+                        if kind == 'message':
+                            self.awsiot_metrics['received'] += 1
+                            await self.process_awsiot_message(topic, payload)
+                            self.awsiot_ingress_latency.record(time.monotonic() - received)
+                        else:
+                            data = {'event_type': self.awsiot_event_name, 'data': {'state': payload, 'topic' : None, 'wildcard' : None}}
+                            await self.send_ad_event(data)
+                    except:
+                        self.logger.critical("There was an error while processing an AWSIoT message")
+                        self.logger.debug('There was an error while processing an AWSIoT message, with Traceback: %s', traceback.format_exc())
+
+                await asyncio.sleep(0) # let other tasks run between batches
+
+    async def process_awsiot_message(self, topic, payload):
+        self.logger.debug("Message Received: Topic = %s, Payload = %s", topic, payload)
+
+        if topic.startswith('$aws/things/') and '/shadow/' in topic:
+            await self.process_shadow_message(topic, payload)
 
-            if self.awsiot_wildcards != [] and list(filter(lambda x: x in topic, self.awsiot_wildcards)) != []: #check if any of the wildcards belong
-                wildcard = list(filter(lambda x: x in topic, self.awsiot_wildcards))[0] + '#'
+        # cached before coalescing, so the last value is kept even for messages that are never sent
+        decoded = None
+        if self.awsiot_state_topics:
+            decoded = await self.cache_awsiot_message(topic, payload)
 
-                data = {'event_type': self.awsiot_event_name, 'data': {'topic': topic, 'payload': msg.payload.decode(), 'wildcard': wildcard}}
+        matches = self.awsiot_coalesce_trie.match(topic)
+        if matches != ():
+            _, mode, interval = min(self.awsiot_coalesce_trie.get(x)[0] for x in matches)
+            await self.coalesce_awsiot_message(topic, payload, mode, interval)
+        else:
+            await self.send_awsiot_message(topic, payload, decoded = decoded)
+
+    async def send_awsiot_message(self, topic, payload, suppressed = None, decoded = None):
+        if decoded is None:
+            decoded = self.decode_payload(topic, payload)
+        payload = decoded # decoded once, and shared by all listeners
+
+        routed = False
+        for topic_filter in self.awsiot_routes.match(topic):
+            for handle in list(self.awsiot_routes.get(topic_filter)):
+                routed = await self.dispatch_awsiot_listener(handle, topic, payload, topic_filter, suppressed) or routed
+
+        if self.awsiot_broadcast is False or (self.awsiot_broadcast == 'unrouted' and routed):
+            return
+
+        # one event is sent for each listened wildcard the topic matches, so every wildcard listener gets it.
+        # All but the most specific are marked as duplicate, so listeners not using a wildcard get it once
+        wildcards = [x for x in self.awsiot_trie.match(topic) if 'wildcard' in self.awsiot_trie.get(x)]
+        wildcards.sort(key = TopicTrie.specificity, reverse = True)
+        if wildcards == []:
+            wildcards = [None]
+
+        for index, wildcard in enumerate(wildcards):
+            data = {'event_type': self.awsiot_event_name, 'data': {'topic': topic, 'payload': payload, 'wildcard': wildcard, 'duplicate': index > 0}}
+            if suppressed is not None:
+                data['data']['suppressed'] = suppressed
+            await self.send_ad_event(data)
+
+    async def cache_awsiot_message(self, topic, raw):
+        # returns the decoded payload when it was decoded here, so it can be reused when sending
+        last_value = self.awsiot_last_values.get(topic)
+        if last_value is not None:
+            if last_value[0] == raw:
+                return None # unchanged, so the entity is left as is
+            entity_id = last_value[1]
 
+        else:
+            matches = self.awsiot_state_trie.match(topic)
+            if matches == ():
+                return None
+
+            if len(self.awsiot_last_values) >= self.awsiot_state_cache_size:
+                if not self.awsiot_state_cache_warned: # warned once, as it would be for every message otherwise
+                    self.awsiot_state_cache_warned = True
+                    self.logger.warning("State cache is full with %s Topics, so Topics like %s will not be cached", self.awsiot_state_cache_size, topic)
+                return None
+
+            entity_id = 'topic.{}'.format(re.sub(r'[^a-z0-9_]', '_', topic.lower()))
+            if entity_id in self.awsiot_state_entities: # such as x/a_b and x/a/b, so told apart by a hash of the topic
+                entity_id = '{}_{:08x}'.format(entity_id, zlib.crc32(topic.encode()))
+            self.awsiot_state_entities[entity_id] = topic
+
+        self.awsiot_last_values[topic] = (bytes(raw), entity_id)
+        payload = self.decode_payload(topic, raw)
+
+        state_key = min(self.awsiot_state_trie.get(x)[0] for x in self.awsiot_state_trie.match(topic))[1]
+        if state_key is not None and isinstance(payload, dict):
+            state = payload.get(state_key)
+        elif isinstance(payload, (str, int, float, bool)):
+            state = payload
+        else:
+            state = None
+
+        attributes = {'topic': topic, 'payload': payload, 'friendly_name': topic}
+        await self.state_update(entity_id, {'state': state, 'attributes': attributes})
+        return payload
+
+    async def get_last_value(self, topic):
+        last_value = self.awsiot_last_values.get(topic)
+        if last_value is None:
+            return None
+
+        return copy.deepcopy(self.state[last_value[1]]['attributes']['payload'])
+
+    async def add_awsiot_listener(self, name, topic_filter, callback, kwargs):
+        if not TopicTrie.valid_filter(topic_filter):
+            return None
+
+        app = self.AD.app_management.objects[name]
+        handle = uuid.uuid4().hex
+        self.awsiot_listeners[handle] = {
+            'name': name,
+            'objectid': app['id'],
+            'filter': topic_filter,
+            'function': callback,
+            'pin_app': kwargs.pop('pin', app.get('pin_app')),
+            'pin_thread': kwargs.pop('pin_thread', app.get('pin_thread')),
+            'kwargs': kwargs
+        }
+        self.awsiot_routes.add(topic_filter, handle)
+        return handle
+
+    async def cancel_awsiot_listener(self, handle):
+        listener = self.awsiot_listeners.pop(handle, None)
+        if listener is None:
+            return False
+
+        self.awsiot_routes.remove(listener['filter'], handle)
+        return True
+
+    async def dispatch_awsiot_listener(self, handle, topic, payload, topic_filter, suppressed):
+        listener = self.awsiot_listeners[handle]
+        name = listener['name']
+
+        app = self.AD.app_management.objects.get(name)
+        if app is None or app['id'] != listener['objectid']: # the app was terminated or reloaded
+            await self.cancel_awsiot_listener(handle)
+            return False
+
+        data = {'topic': topic, 'payload': payload, 'wildcard': topic_filter if TopicTrie.has_wildcard(topic_filter) else None}
+        if suppressed is not None:
+            data['suppressed'] = suppressed
+
+        await self.AD.threading.dispatch_worker(name, {
+            'id': handle,
+            'name': name,
+            'objectid': listener['objectid'],
+            'type': 'event',
+            'event': self.awsiot_event_name,
+            'function': listener['function'],
+            'data': data,
+            'pin_app': listener['pin_app'],
+            'pin_thread': listener['pin_thread'],
+            'kwargs': listener['kwargs'],
+        })
+        return True
+
+    async def coalesce_awsiot_message(self, topic, payload, mode, interval):
+        now = self.loop.time()
+        coalesced = self.awsiot_coalesced.get(topic)
+        if coalesced is None:
+            coalesced = self.awsiot_coalesced[topic] = {'last': None, 'payload': None, 'pending': False, 'suppressed': 0}
+
+        if coalesced['last'] is None or (now - coalesced['last'] >= interval and not coalesced['pending']):
+            suppressed = coalesced['suppressed']
+            coalesced['last'] = now
+            coalesced['suppressed'] = 0
+            await self.send_awsiot_message(topic, payload, suppressed)
+
+        elif mode == 'min_interval': # dropped, and counted on the next message sent
+            coalesced['suppressed'] += 1
+
+        else: # last_value, so the latest message is sent once the interval is over
+            if coalesced['pending']:
+                coalesced['suppressed'] += 1
             else:
-                data = {'event_type': self.awsiot_event_name, 'data': {'topic': topic, 'payload': msg.payload.decode(), 'wildcard': None}}
+                coalesced['pending'] = True
+                self.loop.call_later(interval - (now - coalesced['last']), lambda: self.loop.create_task(self.flush_awsiot_message(topic)))
 
-            self.loop.create_task(self.send_ad_event(data))
-        except:
-            self.logger.critical("There was an error while processing an AWSIoT message")
-            self.logger.debug('There was an error while processing an AWSIoT message, with Traceback: %s', traceback.format_exc())
+            coalesced['payload'] = payload
+
+    async def flush_awsiot_message(self, topic):
+        coalesced = self.awsiot_coalesced[topic]
+        payload = coalesced['payload']
+        suppressed = coalesced['suppressed']
+
+        coalesced['last'] = self.loop.time()
+        coalesced['payload'] = None
+        coalesced['pending'] = False
+        coalesced['suppressed'] = 0
+
+        if not self.stopping:
+            await self.send_awsiot_message(topic, payload, suppressed)
 
 
     async def call_plugin_service(self, namespace, domain, service, kwargs):
+        if service.startswith('shadow_'):
+            return await self.call_shadow_service(service, kwargs)
+
         if 'topic' in kwargs:
             if not self.awsiot_connected:  # ensure AWSIoT plugin is connected
                 self.logger.debug("Attempt to call AWSIoT Service while disconnected: %s", service)
@@ -200,8 +1059,21 @@ class AwsiotPlugin(PluginBase):
 
                 if service == 'publish':
                     self.logger.debug("Publish Payload: %s to Topic: %s", payload, topic)
+                    payload = self.encode_payload(topic, payload)
+
+                    if self.awsiot_outbox is not None and (not self.awsiot_connected or self.awsiot_outbox_config.get('always', False)
+                            or self.awsiot_outbox.pending() > 0): # keep the publishes in order
+                        result = await utils.run_in_executor(self, self.awsiot_outbox.append, topic, payload, qos)
+                        if not result:
+                            self.logger.warning("AWSIoT outbox is full, so Payload to Topic %s was dropped", topic)
 
-                    result = await utils.run_in_executor(self, self.awsiot.publish, topic, payload, qos)
+                    else:
+                        try:
+                            result = await self.awsiot_send(topic, payload, qos, kwargs.get('lane'))
+                        except Exception:
+                            if self.awsiot_outbox is None:
+                                raise
+                            result = await utils.run_in_executor(self, self.awsiot_outbox.append, topic, payload, qos)
 
                     if result:
                         self.logger.debug("Publishing Payload %s to Topic %s Successful", payload, topic)
@@ -210,11 +1082,12 @@ class AwsiotPlugin(PluginBase):
                     self.logger.debug("Subscribe to Topic: %s", topic)
 
                     if topic not in self.awsiot_topics:
-                        result = await utils.run_in_executor(self, self.topic_subscribe, topic, qos)
+                        result = await self.awsiot_topic_subscribe(topic, qos)
 
                         if result:
                             self.logger.debug("Subscription to Topic %s Sucessful", topic)
                             self.awsiot_topics.append(topic)
+                            self.awsiot_trie.add(topic, 'subscription')
                         else:
                             self.logger.warning("Subscription to Topic %s was not Sucessful", topic)
                     else:
@@ -223,11 +1096,12 @@ class AwsiotPlugin(PluginBase):
                 elif service == 'unsubscribe':
                     self.logger.debug("Unsubscribe from Topic: %s", topic)
 
-                    result = await utils.run_in_executor(self, self.awsiot.unsubscribe, topic)
+                    result = await utils.run_in_executor(self, self.awsiot_client(topic).unsubscribe, topic)
                     if result:
                         self.logger.debug("Unsubscription from Topic %s Successful", topic)
                         if topic in self.awsiot_topics:
                             self.awsiot_topics.remove(topic)
+                            self.awsiot_trie.remove(topic, 'subscription')
 
                 else:
                     self.logger.warning("Wrong Service Call %s for AWSIoT", service)
@@ -249,16 +1123,408 @@ class AwsiotPlugin(PluginBase):
 
         return result
 
+    #
+    # Device Shadows
+    #
+
+    def awsiot_shadow_add(self, thing):
+        if thing in self.awsiot_shadows:
+            return None
+
+        self.awsiot_shadows[thing] = {'version': None, 'reported': {}, 'desired': {}, 'delta': {}}
+
+        topic = SHADOW_TOPIC.format(thing) + '#'
+        if topic not in self.awsiot_topics:
+            self.awsiot_topics.append(topic)
+            self.awsiot_trie.add(topic, 'subscription')
+            return topic
+
+        return None
+
+    async def call_shadow_service(self, service, kwargs):
+        thing = kwargs.get('thing')
+        if thing is None:
+            self.logger.warning('Thing not provided for Service Call {!r}.'.format(service))
+            raise ValueError("Thing not provided, please provide Thing for Shadow Service Call")
+
+        topic = self.awsiot_shadow_add(thing)
+        if topic is not None and not await self.awsiot_topic_subscribe(topic, self.awsiot_qos):
+            self.logger.warning("Subscription to the Shadow of Thing %s was not Sucessful", thing)
+
+        if service == 'shadow_get':
+            if not await self.awsiot_shadow_request(thing, 'get', {}):
+                return None
+            return await self.get_shadow(thing)
+
+        elif service == 'shadow_update':
+            shadow = self.awsiot_shadows[thing]
+            state = {}
+
+            # only the keys that changed are sent
+            for section in ('reported', 'desired'):
+                if isinstance(kwargs.get(section), dict):
+                    changed = shadow_diff(kwargs[section], shadow[section])
+                    if changed != {}:
+                        state[section] = changed
+
+            if state == {}:
+                self.logger.debug("Nothing changed in the Shadow of Thing %s, so no update sent", thing)
+                return True
+
+            return await self.awsiot_shadow_request(thing, 'update', {'state': state})
+
+        elif service == 'shadow_delete':
+            return await self.awsiot_shadow_request(thing, 'delete', {})
+
+        self.logger.warning("Wrong Service Call %s for AWSIoT", service)
+        return 'ERR'
+
+    async def awsiot_shadow_request(self, thing, operation, document):
+        token = uuid.uuid4().hex
+        document['clientToken'] = token
+        future = self.loop.create_future()
+        self.awsiot_shadow_requests[token] = future
+
+        try:
+            await self.awsiot_publish(SHADOW_TOPIC.format(thing) + operation, json.dumps(document), self.awsiot_qos)
+            return await asyncio.wait_for(future, self.operationalTimeout)
+
+        except asyncio.TimeoutError:
+            self.logger.warning("Shadow %s of Thing %s was not accepted within %s seconds", operation, thing, self.operationalTimeout)
+            return False
+
+        finally:
+            self.awsiot_shadow_requests.pop(token, None)
+
+    async def process_shadow_message(self, topic, payload):
+        levels = topic.split('/')
+        thing = levels[2]
+        operation = '/'.join(levels[4:])
+
+        if thing not in self.awsiot_shadows or not operation.endswith(('/accepted', '/rejected', '/delta')):
+            return
+
+        try:
+            document = json_loads(payload)
+        except ValueError:
+            self.logger.warning("Could not process the Shadow of Thing %s, as its document is not valid JSON", thing)
+            return
+
+        token = document.get('clientToken')
+        future = self.awsiot_shadow_requests.get(token)
+
+        if operation.endswith('/rejected'):
+            self.logger.warning("Shadow %s of Thing %s was rejected with %s", operation.split('/')[0], thing, document.get('message'))
+            if future is not None and not future.done():
+                future.set_result(False)
+            return
+
+        shadow = self.awsiot_shadows[thing]
+        version = document.get('version')
+
+        if version is not None and shadow['version'] is not None and version < shadow['version']:
+            self.logger.debug("Ignoring stale Shadow version %s of Thing %s", version, thing)
+
+        else:
+            state = document.get('state', {})
+
+            if operation == 'get/accepted':
+                shadow['reported'] = state.get('reported', {})
+                shadow['desired'] = state.get('desired', {})
+
+            elif operation == 'update/accepted':
+                shadow_merge(shadow['reported'], state.get('reported') or {})
+                shadow_merge(shadow['desired'], state.get('desired') or {})
+
+            elif operation == 'update/delta':
+                shadow_merge(shadow['desired'], state)
+
+            elif operation == 'delete/accepted':
+                shadow['reported'] = {}
+                shadow['desired'] = {}
+
+            shadow['delta'] = shadow_diff(shadow['desired'], shadow['reported'])
+            shadow['version'] = version
+
+            entity_id = 'shadow.{}'.format(re.sub(r'[^a-z0-9_]', '_', thing.lower()))
+            attributes = copy.deepcopy({x: shadow[x] for x in ('reported', 'desired', 'delta')})
+            attributes['friendly_name'] = '{} Shadow'.format(thing)
+            await self.state_update(entity_id, {'state': version, 'attributes': attributes})
+
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    async def get_shadow(self, thing):
+        if thing not in self.awsiot_shadows:
+            return None
+
+        return copy.deepcopy(self.awsiot_shadows[thing])
+
+    async def state_update(self, entity_id, kwargs):
+        self.logger.debug("Updating State for Entity_ID %s, with %s", entity_id, kwargs)
+
+        old_state = self.state.get(entity_id, {'attributes': {}})
+        new_state = {'state': kwargs.get('state', old_state.get('state')), 'attributes': dict(old_state['attributes'])}
+        new_state['attributes'].update(kwargs.get('attributes', {}))
+
+        try:
+            new_state['last_changed'] = utils.dt_to_str((await self.AD.sched.get_now()).replace(microsecond=0), self.AD.tz) #possible AD isn't ready at this point
+        except:
+            new_state['last_changed'] = None
+
+        self.state[entity_id] = new_state
+        data = {'event_type': 'state_changed', 'data': {'entity_id': entity_id, 'new_state': new_state, 'old_state': old_state}}
+        await self.AD.events.process_event(self.namespace, data)
+
+    async def awsiot_publish(self, topic, payload, qos):
+        start = time.monotonic()
+        try:
+            result = await self.awsiot_publish_message(topic, payload, qos)
+        except Exception:
+            self.awsiot_metrics['publish_failures'] += 1
+            raise
+
+        if result:
+            self.awsiot_metrics['published'] += 1
+            self.awsiot_publish_latency.record(time.monotonic() - start)
+        else:
+            self.awsiot_metrics['publish_failures'] += 1
+
+        return result
+
+    async def awsiot_publish_message(self, topic, payload, qos):
+        if not self.awsiot_pipelined:
+            return await utils.run_in_executor(self, self.awsiot_client(topic).publish, topic, payload, qos)
+
+        # pipelined, so up to publish_window publishes per connection can wait for their ack at the same time
+        slots = self.awsiot_publish_slots[self.awsiot_client_index(topic)]
+        await slots.acquire()
+        try:
+            if qos == 0: # there is no ack for QoS 0
+                self.awsiot_client(topic).publishAsync(topic, payload, qos)
+                return True
+
+            future = self.loop.create_future()
+            self.awsiot_client(topic).publishAsync(topic, payload, qos, ackCallback=functools.partial(self.awsiot_ack, future))
+
+            try:
+                return await asyncio.wait_for(future, self.operationalTimeout)
+            except asyncio.TimeoutError:
+                self.logger.warning("Publish to Topic %s was not acknowledged within %s seconds", topic, self.operationalTimeout)
+                return False
+
+        finally:
+            slots.release()
+
+    async def awsiot_outbox_drain(self):
+        batch = int(self.awsiot_outbox_config.get('batch_size', 100))
+        interval = 1 / self.drainingFrequency if self.drainingFrequency > 0 else 0
+
+        while not self.stopping:
+            await asyncio.sleep(interval)
+
+            if not self.awsiot_connected or self.awsiot_outbox.pending() == 0:
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                records = await utils.run_in_executor(self, self.awsiot_outbox.read, batch)
+            except Exception:
+                self.logger.warning("There was an error while reading the AWSIoT outbox, will try again")
+                self.logger.debug("There was an error while reading the AWSIoT outbox, with Traceback: %s", traceback.format_exc())
+                await asyncio.sleep(1)
+                continue
+
+            if self.awsiot_pipelined and self.awsiot_publish_lanes == []:
+                # the sends start in order, and so call publishAsync in order, while sharing the in-flight window
+                results = await asyncio.gather(*[self.awsiot_send(topic, payload, qos) for topic, payload, qos, _ in records], return_exceptions = True)
+            else:
+                results = []
+                for topic, payload, qos, _ in records:
+                    try:
+                        results.append(await self.awsiot_send(topic, payload, qos))
+                    except Exception as e:
+                        results.append(e)
+                    if not results[-1] or isinstance(results[-1], Exception):
+                        break
+
+            # the records sent before the first failure are committed, and the rest tried again
+            sent = 0
+            while sent < len(results) and results[sent] and not isinstance(results[sent], Exception):
+                sent += 1
+
+            if sent > 0:
+                try:
+                    await utils.run_in_executor(self, self.awsiot_outbox.commit, records[sent - 1][3])
+                    self.logger.debug("Drained %s Publishes from the AWSIoT outbox", sent)
+                except Exception:
+                    self.logger.warning("There was an error while committing the AWSIoT outbox, so %s Publishes may be sent again", sent)
+                    self.logger.debug("There was an error while committing the AWSIoT outbox, with Traceback: %s", traceback.format_exc())
+
+            if sent < len(records):
+                self.logger.warning("Could not drain the AWSIoT outbox, will try again. %s", results[sent] if sent < len(results) else "")
+
+    async def awsiot_send(self, topic, payload, qos, lane = None):
+        if self.awsiot_publish_lanes == []:
+            return await self.awsiot_publish(topic, payload, qos)
+
+        if lane is None:
+            lane = self.awsiot_default_lane
+
+        lanes = [x for x in self.awsiot_publish_lanes if x['name'] == lane]
+        if lanes == []:
+            self.logger.warning("Publish lane %s does not exist, so using %s", lane, self.awsiot_default_lane)
+            lanes = [x for x in self.awsiot_publish_lanes if x['name'] == self.awsiot_default_lane]
+        lane = lanes[0]
+
+        if len(lane['queue']) >= lane['max_queue']:
+            lane['dropped'] += 1
+            if lane['drop_policy'] == 'newest':
+                self.logger.debug("Publish lane %s is full, so Payload to Topic %s was dropped", lane['name'], topic)
+                return False
+
+            _, _, _, future = lane['queue'].popleft()
+            future.set_result(False)
+
+        future = self.loop.create_future()
+        lane['queue'].append((topic, payload, qos, future))
+        self.awsiot_scheduler_event.set()
+
+        if self.awsiot_scheduler_task is None:
+            self.awsiot_scheduler_task = self.loop.create_task(self.awsiot_publish_scheduler())
+
+        return await future
+
+    async def awsiot_publish_scheduler(self):
+        while not self.stopping:
+            lane = next((x for x in self.awsiot_publish_lanes if x['queue']), None)
+            if lane is None:
+                self.awsiot_scheduler_event.clear()
+                await self.awsiot_scheduler_event.wait()
+                continue
+
+            wait = self.awsiot_bucket.take()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue # a higher priority publish may have arrived meanwhile
+
+            topic, payload, qos, future = lane['queue'].popleft()
+            self.loop.create_task(self.awsiot_scheduled_publish(topic, payload, qos, future))
+
+    async def awsiot_scheduled_publish(self, topic, payload, qos, future):
+        try:
+            result = await self.awsiot_publish(topic, payload, qos)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            return
+
+        if not future.done():
+            future.set_result(result)
+
+    def awsiot_ack(self, future, mid, data = True):
+        # runs on the SDK's thread
+        self.loop.call_soon_threadsafe(self.awsiot_ack_resolve, future, data)
+
+    def awsiot_ack_resolve(self, future, data):
+        if not future.done():
+            future.set_result(data)
+
+    def payload_codecs(self, topic):
+        matches = self.awsiot_payload_trie.match(topic)
+        if matches == ():
+            return self.awsiot_payload_format
+
+        return min(self.awsiot_payload_trie.get(x)[0] for x in matches)[1]
+
+    def encode_payload(self, topic, payload):
+        codecs = self.payload_codecs(topic)
+        if codecs == ['text'] and not isinstance(payload, (bytes, bytearray)):
+            return payload # sent as given
+
+        return codec_encode(codecs, payload)
+
+    def decode_payload(self, topic, payload):
+        codecs = self.payload_codecs(topic)
+
+        try:
+            return codec_decode(codecs, payload)
+        except Exception as e:
+            self.logger.debug("Could not decode Payload on Topic %s using %s, as %s", topic, '+'.join(codecs), e)
+
+        try:
+            return payload.decode()
+        except UnicodeDecodeError:
+            self.logger.debug("Payload on Topic %s is not valid UTF-8, so passing it as bytes", topic)
+            return payload
+
     async def process_awsiot_wildcard(self, wildcard):
-        if wildcard.rstrip('#') not in self.awsiot_wildcards:
-            self.awsiot_wildcards.append(wildcard.rstrip('#'))
+        if not TopicTrie.valid_filter(wildcard) or not TopicTrie.has_wildcard(wildcard):
+            return False
+
+        self.awsiot_trie.add(wildcard, 'wildcard')
+        return True
 
     async def awsiot_state(self):
         return self.awsiot_connected
     
     async def send_ad_event(self, data):
+        self.awsiot_metrics['dispatched'] += 1
         await self.AD.events.process_event(self.namespace, data)
 
+    async def awsiot_metrics_update(self):
+        last = dict(self.awsiot_metrics)
+        last_time = time.monotonic()
+
+        while not self.stopping:
+            await asyncio.sleep(self.awsiot_metrics_interval)
+
+            now = time.monotonic()
+            metrics = dict(self.awsiot_metrics)
+            elapsed = now - last_time
+
+            def rate(key):
+                return round((metrics[key] - last[key]) / elapsed, 2)
+
+            await self.state_update('sensor.awsiot_messages', {'state': rate('received'), 'attributes': {
+                'received': metrics['received'], 'dispatched': metrics['dispatched'], 'dispatch_rate': rate('dispatched'),
+                'unit_of_measurement': 'msg/s', 'friendly_name': 'AWSIoT Messages'}})
+
+            await self.state_update('sensor.awsiot_publishes', {'state': rate('published'), 'attributes': {
+                'published': metrics['published'], 'failures': metrics['publish_failures'],
+                'unit_of_measurement': 'msg/s', 'friendly_name': 'AWSIoT Publishes'}})
+
+            attributes = self.awsiot_ingress_latency.summary()
+            attributes['friendly_name'] = 'AWSIoT Ingress Latency'
+            await self.state_update('sensor.awsiot_ingress_latency', {'state': attributes['p50'], 'attributes': attributes})
+
+            attributes = self.awsiot_publish_latency.summary()
+            attributes['friendly_name'] = 'AWSIoT Publish Latency'
+            await self.state_update('sensor.awsiot_publish_latency', {'state': attributes['p50'], 'attributes': attributes})
+
+            await self.state_update('sensor.awsiot_ingress_queue', {'state': len(self.awsiot_ingress), 'attributes': {
+                'max_depth': metrics['ingress_max_depth'], 'friendly_name': 'AWSIoT Ingress Queue'}})
+
+            await self.state_update('sensor.awsiot_connection', {'state': 'connected' if self.awsiot_connected else 'disconnected', 'attributes': {
+                'connects': metrics['connects'], 'reconnects': max(metrics['connects'] - 1, 0),
+                'disconnects': metrics['disconnects'], 'friendly_name': 'AWSIoT Connection'}})
+
+            if self.awsiot_outbox is not None:
+                await self.state_update('sensor.awsiot_outbox', {'state': self.awsiot_outbox.pending(), 'attributes': {
+                    'size': self.awsiot_outbox.size(), 'dropped': self.awsiot_outbox.dropped,
+                    'unit_of_measurement': 'B', 'friendly_name': 'AWSIoT Outbox'}})
+
+            for lane in self.awsiot_publish_lanes:
+                await self.state_update('sensor.awsiot_{}_lane'.format(lane['name']), {'state': len(lane['queue']), 'attributes': {
+                    'priority': lane['priority'], 'max_queue': lane['max_queue'], 'dropped': lane['dropped'],
+                    'friendly_name': 'AWSIoT {} Publish Lane'.format(lane['name'].capitalize())}})
+
+            self.awsiot_ingress_latency.reset()
+            self.awsiot_publish_latency.reset()
+            self.awsiot_metrics['ingress_max_depth'] = 0
+            last = metrics
+            last_time = now
+
     #
     # Get initial state
     #
@@ -284,84 +1550,149 @@ class AwsiotPlugin(PluginBase):
     #
 
     async def get_updates(self):
-        already_initialized = False
-        already_notified = False
         first_time = True
 
-        try:
-            await utils.run_in_executor(self, self.start_awsiot_service)
-            await asyncio.wait_for(self.awsiot_connect_event.wait(), 5, loop=self.loop) # wait for it to return true for 5 seconds in case still processing connect
-        except asyncio.TimeoutError:
-            self.logger.critical("Could not Complete Connection to Endpoint, please Ensure Endpoint at URL %s:%s is correct and Endpoint is not down and restart Appdaemon", self.awsiot_endpoint, self.awsiot_port)
+        if self.awsiot_ingress_task is None:
+            self.awsiot_ingress_task = self.loop.create_task(self.awsiot_ingress_consumer())
+
+        if self.awsiot_metrics_interval > 0 and self.awsiot_metrics_task is None:
+            self.awsiot_metrics_task = self.loop.create_task(self.awsiot_metrics_update())
+
+        if self.awsiot_outbox is not None and self.awsiot_outbox_task is None:
+            self.awsiot_outbox_task = self.loop.create_task(self.awsiot_outbox_drain())
+
+        # connect all clients, retrying the ones that could not connect with backoff
+        delay = self.awsiot_baseReconnectQuietTimeSecond
+        pending = list(self.awsiot_clients)
+        while pending != [] and not self.stopping:
+            results = await asyncio.gather(*[utils.run_in_executor(self, self.start_awsiot_service, client) for client in pending])
+            pending = [client for client, result in zip(pending, results) if not result]
+
+            if pending != []:
+                self.logger.critical("Could not Connect to Endpoint at URL %s:%s, will try again in %s seconds", self.awsiot_endpoint, self.awsiot_port, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.awsiot_maxReconnectQuietTimeSecond)
+
+        # supervise the connection, as the SDK reconnects by itself
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.awsiot_connect_event.wait(), 5, loop=self.loop) # wait for it to return true for 5 seconds in case still processing connect
+            except asyncio.TimeoutError:
+                if first_time:
+                    self.logger.critical("Could not Complete Connection to Endpoint, please Ensure Endpoint at URL %s:%s is correct and Endpoint is not down. Will keep waiting", self.awsiot_endpoint, self.awsiot_port)
+                continue
+
+            if self.stopping:
+                break
+
+            #
+            # Register AWSIoT Services
+            #
+            self.AD.services.register_service(self.namespace, "awsiot", "subscribe", self.call_plugin_service)
+            self.AD.services.register_service(self.namespace, "awsiot", "unsubscribe", self.call_plugin_service)
+            self.AD.services.register_service(self.namespace, "awsiot", "publish", self.call_plugin_service)
+            self.AD.services.register_service(self.namespace, "awsiot", "shadow_get", self.call_plugin_service)
+            self.AD.services.register_service(self.namespace, "awsiot", "shadow_update", self.call_plugin_service)
+            self.AD.services.register_service(self.namespace, "awsiot", "shadow_delete", self.call_plugin_service)
+
+            if first_time or self.awsiot_resubscribe:
+                # includes the topics subscribed to using the service, in parallel
+                await self.awsiot_subscribe_topics(list(self.awsiot_topics))
+
+            for thing in self.awsiot_shadows: # load the current shadows into the cache
+                self.loop.create_task(self.call_shadow_service('shadow_get', {'thing': thing}))
 
-        while (self.awsiot_connected or not already_initialized) and not self.stopping: #continue as long as tried to connect
             state = await self.get_complete_state()
             meta = await self.get_metadata()
+            await self.AD.plugins.notify_plugin_started(self.name, self.namespace, meta, state, first_time)
 
-            if self.awsiot_connected : #meaning the client has connected to the Endpoint
-                await self.AD.plugins.notify_plugin_started(self.name, self.namespace, meta, state, first_time)
-                already_notified = False
-                already_initialized = True
+            if first_time:
                 self.logger.info("AWSIoT Plugin initialization complete")
             else:
-                if not already_notified and already_initialized:
-                    await self.AD.plugins.notify_plugin_stopped(self.name, self.namespace)
-                    self.logger.critical("AWSIoT Plugin Stopped Unexpectedly")
-                    already_notified = True
-                    already_initialized = False
-                    first_time = False
-                if not already_initialized and not already_notified:
-                    self.logger.critical("Could not complete AWSIoT Plugin initialization")
-                else:
-                    self.logger.critical("Unable to reinitialize AWSIoT Plugin, will keep trying again until complete")
+                self.logger.info("AWSIoT Plugin reinitialized after reconnection")
+            first_time = False
 
-            if not self.stopping:
+            await self.awsiot_disconnect_event.wait()
+
+            if self.stopping:
                 break
 
-            asyncio.sleep(5)
+            await self.AD.plugins.notify_plugin_stopped(self.name, self.namespace)
+            self.logger.critical("AWSIoT Plugin Stopped Unexpectedly, waiting for reconnection")
 
     def get_namespace(self):
         return self.namespace
 
-    def start_awsiot_service(self):
+    def start_awsiot_service(self, client):
         try:
-            self.awsiot_connect_event.clear() # used to wait for connection
-            self.awsiot.configureEndpoint(self.awsiot_endpoint, self.awsiot_port)
-            self.awsiot.configureLastWill(self.awsiot_will_topic, self.awsiot_will_payload, self.awsiot_qos)
-            self.awsiot.configureCredentials(self.awsiot_ca_cert,self.awsiot_client_key, self.awsiot_client_cert)
-            self.awsiot.configureOfflinePublishQueueing(self.offlinePublishing)
-            self.awsiot.configureMQTTOperationTimeout(self.operationalTimeout)
-            self.awsiot.configureDrainingFrequency(self.drainingFrequency)
-            self.awsiot.configureAutoReconnectBackoffTime(self.awsiot_baseReconnectQuietTimeSecond, self.awsiot_maxReconnectQuietTimeSecond, self.awsiot_stableConnectionTimeSecond)
+            client.configureEndpoint(self.awsiot_endpoint, self.awsiot_port)
+            if client is self.awsiot:
+                client.configureLastWill(self.awsiot_will_topic, self.awsiot_will_payload, self.awsiot_qos)
+            client.configureCredentials(self.awsiot_ca_cert,self.awsiot_client_key, self.awsiot_client_cert)
+            client.configureOfflinePublishQueueing(self.offlinePublishing)
+            client.configureMQTTOperationTimeout(self.operationalTimeout)
+            client.configureDrainingFrequency(self.drainingFrequency)
+            client.configureAutoReconnectBackoffTime(self.awsiot_baseReconnectQuietTimeSecond, self.awsiot_maxReconnectQuietTimeSecond, self.awsiot_stableConnectionTimeSecond)
             if self.awsiot_enableMetrics:
-                self.awsiot.enableMetricsCollection()
+                client.enableMetricsCollection()
             else:
-                self.awsiot.disableMetricsCollection()
+                client.disableMetricsCollection()
 
-            res = self.awsiot.connect(keepAliveIntervalSecond=self.awsiot_timeout)
-
-            if res:
-                for topic in self.awsiot_topics:
-                    self.logger.debug("Subscribing to Topic: %s", topic)
-                    result = self.topic_subscribe(topic, self.awsiot_qos)
-                    if result:
-                        self.logger.debug("Subscription to Topic %s Sucessful", topic)
-                    else:
-                        self.awsiot_topics.remove(topic)
-                        self.logger.debug("Subscription to Topic %r Unsucessful, as Client possibly not currently connected", topic)
+            return client.connect(keepAliveIntervalSecond=self.awsiot_timeout)
 
         except AWSIoTExceptions.connectTimeoutException as ae:
             self.logger.critical("There was a Time Out Connection error while trying to setup the AWSIoT Service, as %s", ae)
             self.logger.debug("There was a Time Out Connection error while trying to setup the AWSIoT Service with Traceback: %s", traceback.format_exc())
-        return
+        except Exception as e: # such as connectError, or an OSError when there is no network yet
+            self.logger.critical("There was a Connection error while trying to setup the AWSIoT Service, as %r", e)
+            self.logger.debug("There was a Connection error while trying to setup the AWSIoT Service with Traceback: %s", traceback.format_exc())
+        return False
+
+    async def awsiot_subscribe_topics(self, topics):
+        # all subscriptions are issued at once, and their SUBACKs gathered together
+        results = await asyncio.gather(*[self.awsiot_topic_subscribe(topic, self.awsiot_qos) for topic in topics])
+
+        failed = []
+        for topic, result in zip(topics, results):
+            if result:
+                self.logger.debug("Subscription to Topic %s Sucessful", topic)
+            else:
+                failed.append(topic)
+                self.logger.debug("Subscription to Topic %r Unsucessful, as Client possibly not currently connected. Will retry", topic)
+
+        if failed != []:
+            self.loop.create_task(self.awsiot_subscribe_retry(failed))
+
+        return failed == []
+
+    async def awsiot_subscribe_retry(self, topics):
+        delay = self.awsiot_baseReconnectQuietTimeSecond
+        while topics != [] and not self.stopping:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.awsiot_maxReconnectQuietTimeSecond)
 
-    def topic_subscribe(self, topic, qos):
-        res = False
+            topics = [x for x in topics if x in self.awsiot_topics] # unsubscribed in the meantime
+            results = await asyncio.gather(*[self.awsiot_topic_subscribe(topic, self.awsiot_qos) for topic in topics])
+            topics = [topic for topic, result in zip(topics, results) if not result]
+
+    async def awsiot_topic_subscribe(self, topic, qos):
+        self.logger.debug("Subscribing to Topic: %s", topic)
+        future = self.loop.create_future()
         try:
-            res = self.awsiot.subscribe(topic, qos, self.awsiot_on_message)
-        except AWSIoTExceptions.subscribeTimeoutException as se:
+            self.awsiot_client(topic).subscribeAsync(topic, qos, ackCallback=functools.partial(self.awsiot_ack, future), messageCallback=self.awsiot_on_message)
+            granted = await asyncio.wait_for(future, self.operationalTimeout)
+
+        except asyncio.TimeoutError:
+            self.logger.critical("There was a Subscription Time Out error, while trying to Subscribe to Topic %r", topic)
+            return False
+
+        except Exception as se:
             self.logger.critical("There was a Subscription error %r, while trying to Subscribe to Topic %r", se, topic)
             self.logger.debug("There was a Subscription error %r, while trying to Subscribe to Topic %r with Traceback: %s", se, topic, traceback.format_exc())
+            return False
+
+        if isinstance(granted, (list, tuple)):
+            granted = granted[0]
 
-        return res
+        return granted != 128 # 128 is the SUBACK failure code
 
@@ -0,0 +1,408 @@
+"""
+Throughput benchmark for the AWSIoT plugin, which runs without an AWS endpoint.
+
+The plugin is run against ``FakeAWSIoTMQTTClient``, a local stand-in for ``AWSIoTPyMQTT.AWSIoTMQTTClient``
+which delivers its callbacks from a single network thread like the SDK does, and against a minimal
+AppDaemon object which counts what reaches ``AD.events.process_event``. Messages are injected at a
+controlled rate and topic distribution, and the following is reported:
+
+  - end to end messages/sec from ``awsiot_on_message`` into ``AD.events.process_event``, with latency percentiles
+  - publish throughput and acknowledgement latency percentiles
+  - peak memory allocated while running
+
+With ``--codecs``, the payload codecs are benchmarked instead, reporting the encoded size and the
+encode and decode time of each available codec on a sample telemetry payload.
+
+The fake client loops back publishes to its own subscriptions, and answers Device Shadow requests,
+so it can also be used as a local MQTT stand-in when trying out the plugin.
+
+Run it from within the plugin's folder, with the plugin's requirements and AppDaemon installed:
+
+.. code:: bash
+
+    python benchmark.py --messages 100000 --topics 50
+    python benchmark.py --publishes 20000 --qos 1 --ack-delay 20 --pipelined --window 100
+    python benchmark.py --codecs
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import timeit
+import tracemalloc
+from datetime import datetime, timezone
+
+import awsiotplugin
+from awsiotplugin import AwsiotPlugin, TopicTrie
+
+
+class FakeMessage:
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class FakeAWSIoTMQTTClient:
+    """Local stand-in for ``AWSIoTMQTTClient``, delivering callbacks from a single network thread"""
+
+    ack_delay = 0.0 # seconds before a QoS 1 publish or a subscription is acknowledged
+
+    def __init__(self, clientID, protocolType = 4, useWebsocket = False, cleanSession = True):
+        self.client_id = clientID
+        self.onOnline = None
+        self.onOffline = None
+        self.connected = False
+        self.subscriptions = TopicTrie()
+        self.callbacks = {}
+        self.shadows = {}
+        self.mid = itertools.count(1)
+
+        self.pending = []
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.thread = threading.Thread(target = self.network_loop, name = 'fake-mqtt-{}'.format(clientID), daemon = True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        if name.startswith(('configure', 'enable', 'disable')):
+            return lambda *args, **kwargs: True
+        raise AttributeError(name)
+
+    #
+    # Network thread
+    #
+
+    def schedule(self, delay, callback, *args):
+        with self.condition:
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.sequence), callback, args))
+            self.condition.notify()
+
+    def network_loop(self):
+        while True:
+            with self.condition:
+                while self.pending == [] or self.pending[0][0] > time.monotonic():
+                    self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending != [] else None)
+                _, _, callback, args = heapq.heappop(self.pending)
+
+            callback(*args)
+
+    #
+    # Client API
+    #
+
+    def connect(self, keepAliveIntervalSecond = 600):
+        self.connected = True
+        if self.onOnline is not None:
+            self.schedule(0, self.onOnline)
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        return True
+
+    def go_offline(self):
+        """Simulates the connection dropping"""
+        self.connected = False
+        if self.onOffline is not None:
+            self.schedule(0, self.onOffline)
+
+    def subscribe(self, topic, QoS, callback):
+        self.subscriptions.add(topic)
+        self.callbacks[topic] = callback
+        return True
+
+    def subscribeAsync(self, topic, QoS, ackCallback = None, messageCallback = None):
+        mid = next(self.mid)
+        self.subscribe(topic, QoS, messageCallback)
+        if ackCallback is not None:
+            self.schedule(self.ack_delay, ackCallback, mid, (QoS,))
+        return mid
+
+    def unsubscribe(self, topic):
+        self.subscriptions.remove(topic)
+        self.callbacks.pop(topic, None)
+        return True
+
+    def publish(self, topic, payload, QoS):
+        if QoS > 0 and self.ack_delay > 0:
+            time.sleep(self.ack_delay)
+        self.schedule(0, self.loopback, topic, payload)
+        return True
+
+    def publishAsync(self, topic, payload, QoS, ackCallback = None):
+        mid = next(self.mid)
+        self.schedule(0, self.loopback, topic, payload)
+        if QoS > 0 and ackCallback is not None:
+            self.schedule(self.ack_delay, ackCallback, mid)
+        return mid
+
+    def inject(self, topic, payload):
+        """Delivers a message as if it was received from the broker"""
+        self.schedule(0, self.deliver, topic, payload)
+
+    def deliver(self, topic, payload):
+        if isinstance(payload, str):
+            payload = payload.encode()
+
+        for topic_filter in self.subscriptions.match(topic):
+            callback = self.callbacks.get(topic_filter)
+            if callback is not None:
+                callback(self, None, FakeMessage(topic, payload))
+
+    def loopback(self, topic, payload):
+        if topic.startswith('$aws/things/') and '/shadow/' in topic:
+            self.shadow_request(topic, payload)
+        else:
+            self.deliver(topic, payload)
+
+    def shadow_request(self, topic, payload):
+        levels = topic.split('/')
+        thing, operation = levels[2], levels[4]
+        base = '$aws/things/{}/shadow/{}'.format(thing, operation)
+        request = json.loads(payload or '{}')
+        shadow = self.shadows.setdefault(thing, {'state': {'reported': {}, 'desired': {}}, 'version': 0})
+        response = {'clientToken': request.get('clientToken'), 'version': shadow['version']}
+
+        if operation == 'get':
+            response['state'] = shadow['state']
+
+        elif operation == 'update':
+            shadow['version'] += 1
+            response['version'] = shadow['version']
+            response['state'] = request.get('state', {})
+            for section, values in response['state'].items():
+                awsiotplugin.shadow_merge(shadow['state'].setdefault(section, {}), values)
+
+            delta = awsiotplugin.shadow_diff(shadow['state'].get('desired', {}), shadow['state'].get('reported', {}))
+            if delta != {}:
+                self.deliver(base + '/delta', json.dumps({'state': delta, 'version': shadow['version']}))
+
+        elif operation == 'delete':
+            del self.shadows[thing]
+
+        self.deliver(base + '/accepted', json.dumps(response))
+
+
+class FakeEvents:
+    def __init__(self, bench):
+        self.bench = bench
+
+    async def process_event(self, namespace, data):
+        self.bench.on_event(data)
+
+
+class FakeAsync:
+    """Accepts any awaited call, returning None"""
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return None
+        return call
+
+
+class FakeSync:
+    """Accepts any call, returning None"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeSched:
+    async def get_now(self):
+        return datetime.now(timezone.utc)
+
+
+class FakeLogging:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: logging.getLogger('benchmark')
+
+
+class FakeAD:
+    """Just enough of AppDaemon to run the plugin"""
+
+    def __init__(self, loop, bench):
+        self.loop = loop
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 10)
+        self.events = FakeEvents(bench)
+        self.plugins = FakeAsync()
+        self.services = FakeSync()
+        self.sched = FakeSched()
+        self.logging = FakeLogging()
+        self.tz = timezone.utc
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.sent = {}
+        self.latencies = []
+        self.received = 0
+        self.done = None
+
+    def on_event(self, data):
+        data = data['data']
+        if data.get('topic') is None or 'payload' not in data:
+            return
+
+        now = time.perf_counter()
+        sent = self.sent.pop(int(data['payload']), None)
+        if sent is not None:
+            self.latencies.append(now - sent)
+
+        self.received += 1
+        if self.received >= self.args.messages and not self.done.done():
+            self.done.set_result(now)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self.done = loop.create_future()
+
+        awsiotplugin.AWSIoTPyMQTT.AWSIoTMQTTClient = FakeAWSIoTMQTTClient
+        FakeAWSIoTMQTTClient.ack_delay = self.args.ack_delay / 1000
+
+        config = {
+            'type': 'awsiot',
+            'namespace': 'awsiot',
+            'client_endpoint': 'localhost',
+            'client_topics': ['bench/#'],
+            'pipelined_publish': self.args.pipelined,
+            'publish_window': self.args.window,
+            'metrics_interval': 0,
+            'client_connections': self.args.connections,
+        }
+        plugin = AwsiotPlugin(FakeAD(loop, self), 'AWSIOT', config)
+        loop.create_task(plugin.get_updates())
+        await asyncio.wait_for(plugin.awsiot_connect_event.wait(), 5)
+
+        tracemalloc.start()
+
+        if self.args.messages > 0:
+            await self.run_ingress(plugin)
+
+        if self.args.publishes > 0:
+            await self.run_publish(plugin)
+
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('Peak memory allocated: {:.1f} KiB'.format(peak / 1024))
+
+        plugin.stopping = True
+
+    async def run_ingress(self, plugin):
+        topics = ['bench/device{}/telemetry'.format(i) for i in range(self.args.topics)]
+        weights = [1 / (i + 1) for i in range(len(topics))] if self.args.skewed else None
+        client = plugin.awsiot_client('bench/#')
+        while 'bench/#' not in client.callbacks: # wait for the subscription
+            await asyncio.sleep(0.01)
+
+        interval = 1 / self.args.rate if self.args.rate > 0 else 0
+
+        def produce():
+            start = time.perf_counter()
+            for i, topic in enumerate(random.choices(topics, weights, k = self.args.messages)):
+                if interval > 0:
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                self.sent[i] = time.perf_counter()
+                client.inject(topic, str(i))
+
+        start = time.perf_counter()
+        threading.Thread(target = produce, daemon = True).start()
+        end = await asyncio.wait_for(self.done, self.args.timeout)
+
+        print('Ingress: {} messages over {} topics in {:.3f}s, {:.0f} msg/s'.format(
+            self.received, len(topics), end - start, self.received / (end - start)))
+        self.report('Ingress latency', self.latencies)
+
+    async def run_publish(self, plugin):
+        latencies = []
+
+        async def publish(i):
+            start = time.perf_counter()
+            if await plugin.awsiot_publish('bench_out/{}'.format(i % 10), str(i), self.args.qos):
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[publish(i) for i in range(self.args.publishes)])
+        elapsed = time.perf_counter() - start
+
+        print('Publish: {} of {} acknowledged in {:.3f}s, {:.0f} msg/s ({}, QoS {})'.format(
+            len(latencies), self.args.publishes, elapsed, len(latencies) / elapsed,
+            'pipelined' if self.args.pipelined else 'executor', self.args.qos))
+        self.report('Publish latency', latencies)
+
+    def report(self, name, latencies):
+        if latencies == []:
+            return
+
+        latencies.sort()
+        def percentile(p):
+            return latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000
+
+        print('{}: p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(
+            name, percentile(50), percentile(90), percentile(99), latencies[-1] * 1000))
+
+
+def run_codecs(iterations):
+    payload = {
+        'device': 'gateway-0042',
+        'timestamp': 1602979200123,
+        'firmware': '2.4.1',
+        'readings': [{'sensor': 'temperature_{}'.format(i), 'value': 21.5 + i / 10, 'unit': 'C', 'ok': True} for i in range(20)],
+    }
+    baseline = len(awsiotplugin.codec_encode(['json'], payload))
+
+    chains = ['json', 'json+zlib', 'json+deflate']
+    for codec in ('msgpack', 'cbor'):
+        if codec in awsiotplugin.PAYLOAD_CODECS:
+            chains.extend([codec, codec + '+zlib'])
+        else:
+            print('{} is not installed, so not benchmarked'.format(codec))
+
+    print('{:<16}{:>10}{:>10}{:>14}{:>14}'.format('codec', 'bytes', 'ratio', 'encode us', 'decode us'))
+    for name in chains:
+        codecs = awsiotplugin.parse_codecs(name)
+        encoded = awsiotplugin.codec_encode(codecs, payload)
+        assert awsiotplugin.codec_decode(codecs, encoded) == payload
+
+        encode = timeit.timeit(lambda: awsiotplugin.codec_encode(codecs, payload), number = iterations) / iterations
+        decode = timeit.timeit(lambda: awsiotplugin.codec_decode(codecs, encoded), number = iterations) / iterations
+        print('{:<16}{:>10}{:>10.2f}{:>14.2f}{:>14.2f}'.format(name, len(encoded), baseline / len(encoded), encode * 1e6, decode * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'AWSIoT plugin throughput benchmark')
+    parser.add_argument('--messages', type = int, default = 50000, help = 'messages to inject, 0 to skip')
+    parser.add_argument('--rate', type = float, default = 0, help = 'messages/sec to inject at, 0 for as fast as possible')
+    parser.add_argument('--topics', type = int, default = 100, help = 'number of distinct topics')
+    parser.add_argument('--skewed', action = 'store_true', help = 'use a skewed rather than uniform topic distribution')
+    parser.add_argument('--publishes', type = int, default = 5000, help = 'publishes to make, 0 to skip')
+    parser.add_argument('--qos', type = int, default = 1, help = 'QoS of the publishes')
+    parser.add_argument('--ack-delay', type = float, default = 5, help = 'simulated round trip in milliseconds')
+    parser.add_argument('--pipelined', action = 'store_true', help = 'use pipelined publishes')
+    parser.add_argument('--window', type = int, default = 20, help = 'in-flight window of pipelined publishes')
+    parser.add_argument('--connections', type = int, default = 1, help = 'number of client connections')
+    parser.add_argument('--codecs', action = 'store_true', help = 'benchmark the payload codecs instead')
+    parser.add_argument('--timeout', type = float, default = 120, help = 'seconds to wait for all messages')
+    args = parser.parse_args()
+
+    if args.codecs:
+        run_codecs(10000)
+        return
+
+    asyncio.get_event_loop().run_until_complete(Benchmark(args).run())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Hardware Stats agent, which samples the host it runs on with the plugin's own samplers, and sends
+the readings to a Hardware Stats plugin running in collector mode.
+
+Each cycle, the agent sends one frame holding all the sampled sensors, as msgpack if installed,
+else as zlib compressed JSON, over UDP or a Unix datagram socket. The plugin makes the readings
+into per host entities like ``sensor.<host>_virtual_memory``, and marks the host as stale when its
+frames stop.
+
+Only psutil, and msgpack if wanted, are needed on the host, not AppDaemon. Copy ``hwstatsplugin.py``
+alongside this script, and run for example:
+
+.. code:: bash
+
+    python agent.py --target udp://appdaemon.local:9955 --interval 5
+    python agent.py --target unix:///tmp/hwstats.sock --host test1 --interval 1 --backend proc
+
+Several agents with different ``--host`` names can be run on one machine, to try out the collector.
+"""
+
+import argparse
+import logging
+import socket
+import sys
+import time
+from datetime import datetime
+
+import hwstatsplugin
+
+
+def open_target(target):
+    """Returns the socket and address to send the frames to"""
+    if target.startswith("unix://"):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM), target[len("unix://"):]
+
+    if target.startswith("udp://"):
+        target = target[len("udp://"):]
+    host, port = target.rsplit(":", 1)
+    family, kind, proto, _, address = socket.getaddrinfo(host, int(port), type = socket.SOCK_DGRAM)[0]
+    return socket.socket(family, kind, proto), address
+
+
+def run(args):
+    logger = logging.getLogger("hwstats.agent")
+    sampler = hwstatsplugin.HostSampler(args.backend, "process" in args.sensors)
+    samplers = sampler.samplers()
+    sock, address = open_target(args.target)
+    use_msgpack = args.format == "msgpack"
+    if use_msgpack and hwstatsplugin.msgpack is None:
+        logger.warning("msgpack is not installed, so sending zlib compressed JSON")
+
+    logger.info("Sending %s from %s to %s every %ss", ", ".join(args.sensors), args.host, args.target, args.interval)
+    seq = 0
+    started = time.monotonic()
+
+    while True:
+        batch = {}
+        nowTime = datetime.now().replace(microsecond=0)
+        for group in args.sensors:
+            try:
+                samplers[group](nowTime, batch)
+            except Exception:
+                logger.warning("There was an error while sampling Sensor %s", group, exc_info = True)
+
+        frame = {"host": args.host, "seq": seq, "interval": args.interval, "sensors": {x: [y["state"], y["attributes"]] for x, y in batch.items()}}
+        data = hwstatsplugin.encode_frame(frame, use_msgpack)
+        try:
+            sock.sendto(data, address)
+            logger.debug("Sent frame %s with %s sensors in %s bytes", seq, len(batch), len(data))
+        except OSError as e: # the collector isn't running, so the frame is lost
+            logger.debug("Could not send frame %s to %s, as %s", seq, args.target, e)
+
+        seq += 1
+        time.sleep(max(0, started + seq * args.interval - time.monotonic()))
+
+
+def main():
+    groups = ["cpu", "memory", "temperature", "uptime", "network", "process"]
+    parser = argparse.ArgumentParser(description = "Hardware Stats agent, sending to a Hardware Stats plugin in collector mode")
+    parser.add_argument("--target", default = "udp://127.0.0.1:9955", help = "udp://host:port or unix:///path of the collector")
+    parser.add_argument("--host", default = socket.gethostname(), help = "name of this host, used in its entity names")
+    parser.add_argument("--interval", type = float, default = 5, help = "seconds between frames")
+    parser.add_argument("--sensors", nargs = "+", choices = groups, default = ["cpu", "memory", "temperature", "uptime", "network"], help = "sensor groups to send")
+    parser.add_argument("--backend", choices = ["psutil", "proc"], default = "psutil", help = "how the sensors are read")
+    parser.add_argument("--format", choices = ["msgpack", "json"], default = "msgpack", help = "frame format, json being zlib compressed")
+    parser.add_argument("--verbose", action = "store_true", help = "log every frame sent")
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO, format = "%(asctime)s %(levelname)s %(message)s")
+    try:
+        run(args)
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
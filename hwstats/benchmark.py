@@ -0,0 +1,94 @@
+"""
+Sampling cost benchmark for the Hardware Stats plugin.
+
+The psutil backend and, on Linux, the ``/proc`` and ``/sys`` backend are each used to read every sensor
+group many times over, and the following is reported per backend:
+
+  - wall and CPU time per read of each sensor group
+  - wall and CPU time per full sampling cycle over all the groups
+  - the share of a core used when sampling every ``--interval`` seconds
+
+Run it from within the plugin's folder, with psutil and AppDaemon installed:
+
+.. code:: bash
+
+    python benchmark.py --cycles 5000
+    python benchmark.py --cycles 2000 --interval 0.1
+"""
+
+import argparse
+import sys
+import time
+
+import hwstatsplugin
+
+
+GROUPS = {
+    "cpu": "cpu_freq",
+    "memory": ("virtual_memory", "swap_memory"),
+    "temperature": "temperatures",
+    "network": "net_io",
+    "process": "process",
+}
+
+
+def readers(backend):
+    """Returns the backend's readers for each sensor group, as sampled by the plugin"""
+    result = {}
+    for group, methods in GROUPS.items():
+        if isinstance(methods, str):
+            methods = (methods,)
+        result[group] = [getattr(backend, x) for x in methods]
+    return result
+
+
+def measure(functions, cycles):
+    for function in functions: # warm up, and fail early if a sensor can't be read here
+        function()
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for _ in range(cycles):
+        for function in functions:
+            function()
+    return (time.perf_counter() - wall) / cycles, (time.process_time() - cpu) / cycles
+
+
+def run_backend(name, backend, cycles, interval):
+    print("{} backend".format(name))
+    print("{:<14}{:>12}{:>12}".format("group", "wall us", "cpu us"))
+
+    cycle = []
+    for group, functions in readers(backend).items():
+        try:
+            wall, cpu = measure(functions, cycles)
+        except Exception as e:
+            print("{:<14}{:>24}".format(group, "not available ({})".format(type(e).__name__)))
+            continue
+
+        cycle.extend(functions)
+        print("{:<14}{:>12.1f}{:>12.1f}".format(group, wall * 1e6, cpu * 1e6))
+
+    wall, cpu = measure(cycle, cycles)
+    print("{:<14}{:>12.1f}{:>12.1f}".format("cycle", wall * 1e6, cpu * 1e6))
+    print("CPU used when sampling every {}s: {:.3f}% of a core".format(interval, cpu / interval * 100))
+    print()
+    backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Hardware Stats plugin sampling cost benchmark")
+    parser.add_argument("--cycles", type = int, default = 2000, help = "sampling cycles per backend")
+    parser.add_argument("--interval", type = float, default = 1.0, help = "sampling interval to report the CPU share at")
+    args = parser.parse_args()
+
+    run_backend("psutil", hwstatsplugin.PsutilSensors(), args.cycles, args.interval)
+
+    if sys.platform.startswith("linux"):
+        run_backend("proc", hwstatsplugin.ProcSensors(), args.cycles, args.interval)
+    else:
+        print("The proc backend is only available on Linux")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,643 @@
+import array
 import asyncio
+import bisect
+import collections
 import copy
 import ssl
 import json
+import math
 import psutil
 from datetime import datetime
 import calendar
-import appdaemon.utils as utils
-from appdaemon.appdaemon import AppDaemon
-from appdaemon.plugin_management import PluginBase
-
+import gc
+import glob
+import os
+import re
+import socket
+import sys
+import time
 import traceback
-import appdaemon.utils as utils
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import appdaemon.utils as utils
+    from appdaemon.appdaemon import AppDaemon
+    from appdaemon.plugin_management import PluginBase
+except ImportError: # agent.py runs the host samplers on machines without AppDaemon
+    utils = AppDaemon = None
+    PluginBase = object
+
+def exceeds_deadband(new, old, absolute = 0, percent = 0):
+    """Returns True, if new differs from old by more than the deadband"""
+    numbers = (int, float)
+    if isinstance(new, bool) or isinstance(old, bool) or not isinstance(new, numbers) or not isinstance(old, numbers):
+        return new != old
+
+    return abs(new - old) > max(absolute, abs(old) * percent / 100)
+
+class TimingWheel:
+    """Hashed timing wheel, returning the items due on each tick"""
+
+    def __init__(self, slots = 64):
+        self.slots = [[] for _ in range(slots)]
+        self.tick = 0
+
+    def schedule(self, item, ticks):
+        due = self.tick + max(1, ticks)
+        self.slots[due % len(self.slots)].append((due, item))
+
+    def advance(self):
+        self.tick += 1
+        slot = self.slots[self.tick % len(self.slots)]
+        due = [x[1] for x in slot if x[0] <= self.tick]
+        if due != []:
+            slot[:] = [x for x in slot if x[0] > self.tick] # the rest are due on later rounds
+        return due
+
+class LagHistogram:
+    """Fixed bucket histogram of event loop lags in seconds, with approximate percentiles"""
+
+    BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the percentile"""
+        if self.count == 0:
+            return None
+
+        target = self.count * percent / 100
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(self.BUCKETS[i], self.max) if i < len(self.BUCKETS) else self.max
+
+        return self.max
+
+class RollingWindows:
+    """Ring buffer of a sensor's samples, keeping the sum, min and max over each window incrementally,
+    with approximate percentiles from an evenly strided subset of at most 128 of the window's samples.
+    Samples coming sooner than period after the last one are skipped, so the capacity can span the largest window"""
+
+    def __init__(self, windows, capacity, period = 0):
+        self.windows = windows # in seconds
+        self.capacity = capacity
+        self.period = period
+        self.times = array.array("d", bytes(8 * capacity))
+        self.values = array.array("d", bytes(8 * capacity))
+        self.count = 0 # samples added so far, so sample i is at i % capacity
+        self.starts = [0] * len(windows) # oldest sample in each window
+        self.sums = [0.0] * len(windows)
+        self.minimums = [collections.deque() for _ in windows] # samples with increasing values, for the min
+        self.maximums = [collections.deque() for _ in windows] # samples with decreasing values, for the max
+
+    def add(self, when, value):
+        index = self.count
+        capacity = self.capacity
+        if index > 0 and when - self.times[(index - 1) % capacity] < self.period:
+            return
+
+        # samples leave a window when too old, or when about to be overwritten in the ring
+        for w, window in enumerate(self.windows):
+            start = self.starts[w]
+            while start < index and (start <= index - capacity or self.times[start % capacity] <= when - window):
+                self.sums[w] -= self.values[start % capacity]
+                start += 1
+            self.starts[w] = start
+
+            for extremes in (self.minimums[w], self.maximums[w]):
+                while extremes and extremes[0] < start:
+                    extremes.popleft()
+
+        self.times[index % capacity] = when
+        self.values[index % capacity] = value
+        self.count += 1
+
+        for w in range(len(self.windows)):
+            if index % capacity == 0: # now and then, so rounding errors don't build up
+                self.sums[w] = sum(self.values[i % capacity] for i in range(self.starts[w], self.count))
+            else:
+                self.sums[w] += value
+
+            minimum = self.minimums[w]
+            while minimum and self.values[minimum[-1] % capacity] >= value:
+                minimum.pop()
+            minimum.append(index)
+
+            maximum = self.maximums[w]
+            while maximum and self.values[maximum[-1] % capacity] <= value:
+                maximum.pop()
+            maximum.append(index)
+
+    def stats(self, w, percentiles):
+        start = self.starts[w]
+        size = self.count - start
+        capacity = self.capacity
+        stats = {
+            "min" : self.values[self.minimums[w][0] % capacity],
+            "max" : self.values[self.maximums[w][0] % capacity],
+            "mean" : self.sums[w] / size
+        }
+
+        subset = sorted(self.values[i % capacity] for i in range(start, self.count, max(1, -(-size // 128)))) # stride rounded up, so at most 128 samples are sorted
+        for percent in percentiles:
+            stats["p{}".format(percent)] = subset[round(percent / 100 * (len(subset) - 1))]
+        return stats
+
+def window_name(seconds):
+    if seconds % 3600 == 0:
+        return "{}h".format(seconds // 3600)
+    if seconds % 60 == 0:
+        return "{}m".format(seconds // 60)
+    return "{}s".format(seconds)
+
+def common_tick(intervals):
+    """Returns the longest tick all the intervals are multiples of, to the millisecond"""
+    tick = 0
+    for interval in intervals:
+        tick = math.gcd(tick, round(interval * 1000))
+    return tick / 1000
+
+def callback_name(callback):
+    """Returns a readable name for a callback run by the event loop, naming tasks by their coroutine"""
+    owner = getattr(callback, "__self__", None)
+    if isinstance(owner, asyncio.Task):
+        coro = owner.get_coro() if hasattr(owner, "get_coro") else getattr(owner, "_coro", None)
+        return "Task {}".format(getattr(coro, "__qualname__", repr(coro)))
+
+    return getattr(callback, "__qualname__", repr(callback))
+
+class CallbackTimer:
+    """Times the callbacks run by the event loops being watched, patching Handle._run only once for all plugins"""
+
+    run = None
+    watchers = {} # the loop, and callback taking the handle and duration, per plugin
+
+    @classmethod
+    def watch(cls, plugin, loop, callback):
+        cls.watchers[plugin] = (loop, callback)
+        if cls.run is None:
+            cls.run = asyncio.events.Handle._run
+            asyncio.events.Handle._run = cls.timed_run
+
+    @classmethod
+    def unwatch(cls, plugin):
+        cls.watchers.pop(plugin, None)
+        if cls.watchers == {} and cls.run is not None:
+            asyncio.events.Handle._run = cls.run
+            cls.run = None
+
+    @staticmethod
+    def timed_run(handle):
+        timer = CallbackTimer
+        watchers = [x[1] for x in timer.watchers.values() if x[0] is handle._loop]
+        if watchers == []: # only the watched loops pay for the timing
+            return timer.run(handle)
+
+        start = time.perf_counter()
+        timer.run(handle)
+        duration = time.perf_counter() - start
+        for callback in watchers:
+            callback(handle, duration)
+
+def pread_into(fd, buf):
+    """Re-reads a /proc or /sys file from the start into buf, growing buf if the file does not fit"""
+    while True:
+        if hasattr(os, 'preadv'):
+            size = os.preadv(fd, [buf], 0)
+        else:
+            data = os.pread(fd, len(buf), 0)
+            size = len(data)
+            buf[:size] = data
+
+        if size < len(buf):
+            return size
+
+        buf.extend(bytes(len(buf)))
+
+class PsutilSensors:
+    """Reads the sensors using psutil, which works on all platforms"""
+
+    process_handle = None
+
+    def cpu_freq(self):
+        data = psutil.cpu_freq()
+        return data.current, data.min, data.max
+
+    def virtual_memory(self):
+        data = psutil.virtual_memory()
+        return {"percent" : data.percent, "used" : data.used, "free" : data.free, "total" : data.total, "available" : data.available,
+            "active" : data.active, "inactive" : data.inactive, "buffers" : data.buffers, "cached" : data.cached, "shared" : data.shared}
+
+    def swap_memory(self):
+        data = psutil.swap_memory()
+        return {"percent" : data.percent, "used" : data.used, "free" : data.free, "total" : data.total}
+
+    def temperatures(self):
+        return {k: (v[0].current, v[0].high, v[0].critical) for k, v in psutil.sensors_temperatures().items() if v != []}
+
+    def net_io(self):
+        return {k: (v.bytes_sent, v.bytes_recv, v.packets_sent, v.packets_recv) for k, v in psutil.net_io_counters(pernic=True).items()}
+
+    def process(self):
+        if self.process_handle is None:
+            self.process_handle = psutil.Process()
+
+        handle = self.process_handle
+        with handle.oneshot():
+            try:
+                memory = handle.memory_full_info()
+                uss = memory.uss
+            except (psutil.AccessDenied, AttributeError):
+                memory = handle.memory_info()
+                uss = None
+            cpu = handle.cpu_times()
+            switches = handle.num_ctx_switches()
+            fds = handle.num_fds() if hasattr(handle, "num_fds") else handle.num_handles()
+            return {"rss" : memory.rss, "vms" : memory.vms, "uss" : uss, "user" : cpu.user, "system" : cpu.system,
+                "threads" : handle.num_threads(), "fds" : fds, "voluntary" : switches.voluntary, "involuntary" : switches.involuntary}
+
+    def close(self):
+        return
+
+class ProcSensors(PsutilSensors):
+    """Reads the sensors on Linux from /proc and /sys, like psutil does, but keeps the files open and
+    re-reads them with pread into preallocated buffers, only parsing the fields used.
+    Sensors without the files needed fall back to psutil."""
+
+    MEMINFO = (b"MemTotal", b"MemFree", b"MemAvailable", b"Buffers", b"Cached", b"SReclaimable", b"Shmem",
+        b"Active", b"Inactive", b"SwapTotal", b"SwapFree")
+    STATUS = (b"VmRSS", b"VmSize", b"Threads", b"voluntary_ctxt_switches", b"nonvoluntary_ctxt_switches")
+    SMAPS = (b"Private_Clean", b"Private_Dirty")
+
+    def __init__(self):
+        self.fds = []
+        self.meminfo = self.open("/proc/meminfo")
+        self.meminfo_buf = bytearray(4096)
+        self.meminfo_lines = {} # line of each field, as the layout doesn't change while running
+
+        # the AppDaemon process itself
+        self.status = self.open("/proc/self/status")
+        self.status_buf = bytearray(4096)
+        self.status_lines = {}
+        self.stat = self.open("/proc/self/stat")
+        self.stat_buf = bytearray(1024)
+        self.smaps = self.open("/proc/self/smaps_rollup")
+        self.smaps_buf = bytearray(2048)
+        self.smaps_lines = {}
+        self.clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.net_dev = self.open("/proc/net/dev")
+        self.net_dev_buf = bytearray(4096)
+        self.small_buf = bytearray(32) # for the single value files in /sys
+
+        # cpu frequency, averaged over the cpus like psutil
+        policies = sorted(glob.glob("/sys/devices/system/cpu/cpufreq/policy[0-9]*")) or sorted(glob.glob("/sys/devices/system/cpu/cpu[0-9]*/cpufreq"))
+        self.cpufreq = [x for x in (self.open(os.path.join(y, "scaling_cur_freq")) for y in policies) if x is not None]
+        limits = [(self.read_value(os.path.join(x, "scaling_min_freq")), self.read_value(os.path.join(x, "scaling_max_freq"))) for x in policies]
+        limits = [x for x in limits if None not in x]
+        self.cpufreq_limits = (sum(x[0] for x in limits) / len(limits) / 1000, sum(x[1] for x in limits) / len(limits) / 1000) if limits != [] else (0.0, 0.0)
+
+        # the first temperature of each hwmon device, or the thermal zones if there are none, like psutil
+        self.temperature_sensors = {}
+        for path in sorted(glob.glob("/sys/class/hwmon/hwmon*/temp*_input")):
+            directory, base = os.path.split(path)
+            name = self.read_text(os.path.join(directory, "name")) or os.path.basename(directory)
+            if name in self.temperature_sensors:
+                continue
+            fd = self.open(path)
+            if fd is not None:
+                prefix = os.path.join(directory, base.split("_")[0])
+                self.temperature_sensors[name] = (fd, self.read_value(prefix + "_max", 1000), self.read_value(prefix + "_crit", 1000))
+
+        if self.temperature_sensors == {}:
+            for directory in sorted(glob.glob("/sys/class/thermal/thermal_zone*")):
+                name = self.read_text(os.path.join(directory, "type"))
+                fd = self.open(os.path.join(directory, "temp"))
+                if name is None or fd is None or name in self.temperature_sensors:
+                    continue
+                trips = {}
+                for trip in glob.glob(os.path.join(directory, "trip_point_*_type")):
+                    trips[self.read_text(trip)] = self.read_value(trip[:-len("type")] + "temp", 1000)
+                self.temperature_sensors[name] = (fd, trips.get("high"), trips.get("critical"))
+
+    def open(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        self.fds.append(fd)
+        return fd
+
+    def read_text(self, path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def read_value(self, path, scale = 1):
+        try:
+            return int(self.read_text(path)) / scale
+        except (TypeError, ValueError):
+            return None
+
+    def read_fd(self, fd, scale = 1):
+        size = pread_into(fd, self.small_buf)
+        return int(self.small_buf[:size]) / scale
+
+    def cpu_freq(self):
+        if self.cpufreq == []:
+            return super().cpu_freq()
+
+        current = sum(self.read_fd(x) for x in self.cpufreq) / len(self.cpufreq) / 1000
+        return (current,) + self.cpufreq_limits
+
+    def read_fields(self, fd, buf, line_cache, fields, scale = 1):
+        """Reads the fields of a "Field: value" file like /proc/meminfo"""
+        size = pread_into(fd, buf)
+        lines = buf[:size].split(b"\n")
+        values = {}
+        for field in fields:
+            index = line_cache.get(field)
+            if index is None or index >= len(lines) or not lines[index].startswith(field + b":"):
+                index = next((i for i, x in enumerate(lines) if x.startswith(field + b":")), None)
+                line_cache[field] = index
+            values[field] = int(lines[index].split()[1]) * scale if index is not None else 0
+        return values
+
+    def read_meminfo(self):
+        return self.read_fields(self.meminfo, self.meminfo_buf, self.meminfo_lines, self.MEMINFO, 1024)
+
+    def virtual_memory(self):
+        if self.meminfo is None:
+            return super().virtual_memory()
+
+        values = self.read_meminfo()
+        total = values[b"MemTotal"]
+        free = values[b"MemFree"]
+        available = values[b"MemAvailable"]
+        buffers = values[b"Buffers"]
+        cached = values[b"Cached"] + values[b"SReclaimable"]
+        used = total - available
+        percent = round((total - available) / total * 100, 1) if total else 0.0
+        return {"percent" : percent, "used" : used, "free" : free, "total" : total, "available" : available,
+            "active" : values[b"Active"], "inactive" : values[b"Inactive"], "buffers" : buffers, "cached" : cached, "shared" : values[b"Shmem"]}
+
+    def swap_memory(self):
+        if self.meminfo is None:
+            return super().swap_memory()
+
+        values = self.read_meminfo()
+        total = values[b"SwapTotal"]
+        free = values[b"SwapFree"]
+        used = total - free
+        percent = round(used / total * 100, 1) if total else 0.0
+        return {"percent" : percent, "used" : used, "free" : free, "total" : total}
+
+    def temperatures(self):
+        if self.temperature_sensors == {}:
+            return super().temperatures()
+
+        readings = {}
+        for name, (fd, high, critical) in self.temperature_sensors.items():
+            try:
+                readings[name] = (self.read_fd(fd, 1000), high, critical)
+            except (OSError, ValueError): # some sensors fail to read while suspended
+                continue
+        return readings
+
+    def net_io(self):
+        if self.net_dev is None:
+            return super().net_io()
+
+        size = pread_into(self.net_dev, self.net_dev_buf)
+        counters = {}
+        for line in self.net_dev_buf[:size].split(b"\n")[2:]:
+            if b":" not in line:
+                continue
+            name, data = line.split(b":", 1)
+            fields = data.split()
+            counters[name.strip().decode()] = (int(fields[8]), int(fields[0]), int(fields[9]), int(fields[1]))
+        return counters
+
+    def process(self):
+        if None in (self.status, self.stat, self.smaps):
+            return super().process()
+
+        status = self.read_fields(self.status, self.status_buf, self.status_lines, self.STATUS)
+        smaps = self.read_fields(self.smaps, self.smaps_buf, self.smaps_lines, self.SMAPS, 1024)
+        size = pread_into(self.stat, self.stat_buf)
+        stat = self.stat_buf[:size].rsplit(b")", 1)[1].split() # the name in brackets can have spaces
+        return {"rss" : status[b"VmRSS"] * 1024, "vms" : status[b"VmSize"] * 1024, "uss" : smaps[b"Private_Clean"] + smaps[b"Private_Dirty"],
+            "user" : int(stat[11]) / self.clock_ticks, "system" : int(stat[12]) / self.clock_ticks, "threads" : status[b"Threads"],
+            "fds" : len(os.listdir("/proc/self/fd")), "voluntary" : status[b"voluntary_ctxt_switches"], "involuntary" : status[b"nonvoluntary_ctxt_switches"]}
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+FRAME_MAGIC = b"HWS"
+
+def encode_frame(frame, use_msgpack = True):
+    """Encodes an agent frame as msgpack if installed, else as zlib compressed JSON"""
+    if use_msgpack and msgpack is not None:
+        return FRAME_MAGIC + b"m" + msgpack.packb(frame, use_bin_type=True)
+    return FRAME_MAGIC + b"z" + zlib.compress(json.dumps(frame, separators=(",", ":")).encode())
+
+def decode_frame(data):
+    if data[:3] != FRAME_MAGIC:
+        raise ValueError("not a Hardware Stats frame")
+
+    kind = data[3:4]
+    if kind == b"m":
+        if msgpack is None:
+            raise ValueError("msgpack frame, but msgpack is not installed")
+        return msgpack.unpackb(data[4:], raw=False)
+    if kind == b"z":
+        return json.loads(zlib.decompress(data[4:]))
+    raise ValueError("unknown frame format {!r}".format(kind))
+
+def check_frame(frame):
+    """Raises ValueError, if an agent frame is not in the expected shape"""
+    if not isinstance(frame, dict) or not isinstance(frame.get("host"), str) or frame["host"] == "":
+        raise ValueError("frame without a host")
+    if not isinstance(frame.get("seq", 0), int) or isinstance(frame.get("seq", 0), bool):
+        raise ValueError("seq is not an integer")
+    interval = frame.get("interval")
+    if interval is not None and (isinstance(interval, bool) or not isinstance(interval, (int, float)) or interval <= 0):
+        raise ValueError("interval is not a positive number")
+    if not isinstance(frame.get("sensors"), dict):
+        raise ValueError("frame without sensors")
+
+    for entity_id, reading in frame["sensors"].items():
+        if not isinstance(entity_id, str) or "." not in entity_id:
+            raise ValueError("entity_id {!r} is not valid".format(entity_id))
+        if not isinstance(reading, (list, tuple)) or len(reading) != 2 or not isinstance(reading[1], dict):
+            raise ValueError("reading of {} is not a [state, attributes] pair".format(entity_id))
+
+class CollectorProtocol(asyncio.DatagramProtocol):
+    """Hands the frames sent by the agents to the plugin"""
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def datagram_received(self, data, addr):
+        self.plugin.collector_received(data, addr)
+
+    def error_received(self, exc):
+        self.plugin.logger.debug("Error while receiving from the agents: %s", exc)
+
+class HostSampler:
+    """Samples the host sensor groups into a batch of entity states, for the plugin and for agent.py"""
+
+    def __init__(self, backend = "psutil", process = False):
+        if backend == "proc" and sys.platform.startswith("linux"):
+            self.backend = ProcSensors()
+        else:
+            self.backend = PsutilSensors()
+
+        self.booted = datetime.fromtimestamp(psutil.boot_time()).replace(microsecond=0) #get system up time
+        self.cpu_count = psutil.cpu_count() # does not change while running
+
+        # the process itself, with the gc pauses timed by a gc callback
+        self.process_last = None
+        self.gc_started = None
+        self.gc_pause = 0.0
+        self.gc_max_pause = 0.0
+        if process:
+            gc.callbacks.append(self.gc_callback)
+
+    def samplers(self):
+        return {
+            "cpu" : self.sample_cpu,
+            "memory" : self.sample_memory,
+            "temperature" : self.sample_temperature,
+            "uptime" : self.sample_uptime,
+            "network" : self.sample_network,
+            "process" : self.sample_process
+        }
+
+    def sample_cpu(self, nowTime, batch):
+        entity_id = "sensor.cpu_freq"
+        current, minimum, maximum = self.backend.cpu_freq()
+        kwargs = {"state" : current, "attributes" : {"min" : minimum, "max" : maximum, "friendly_name" : "CPU Frequency"}}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.cpu_count"
+        kwargs = {"state" : self.cpu_count, "attributes" : {"friendly_name" : "CPU Count"}}
+        batch[entity_id] = kwargs
+
+    def sample_memory(self, nowTime, batch):
+        entity_id = "sensor.virtual_memory"
+        data = self.backend.virtual_memory()
+        data["friendly_name"] = "Virtual Memory"
+        kwargs = {"state" : data.pop("percent"), "attributes" : data}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.swap_memory"
+        data = self.backend.swap_memory()
+        data["friendly_name"] = "Swap Memory"
+        kwargs = {"state" : data.pop("percent"), "attributes" : data}
+        batch[entity_id] = kwargs
+
+    def sample_temperature(self, nowTime, batch):
+        data = self.backend.temperatures()
+        for k, (current, high, critical) in data.items():
+            entity_id = "sensor.{}_temperature".format(k)
+            kwargs = {"state" : current, "attributes" : {"hgih" : high, "critical" : critical, "friendly_name" : "{} Temperature".format(k.capitalize())}}
+            batch[entity_id] = kwargs
+
+    def sample_uptime(self, nowTime, batch):
+        entity_id = "sensor.hardware_uptime"
+        uptime = nowTime - self.booted
+        state = str(uptime)
+        days = uptime.days
+        seconds = uptime.seconds
+        kwargs = {"state" : state, "attributes" : {"days" : days, "seconds" : seconds, "friendly_name" : "Hardware Up Time"}}
+        batch[entity_id] = kwargs
+
+    def sample_network(self, nowTime, batch):
+        data = self.backend.net_io()
+        for k, (bytes_sent, bytes_recv, packets_sent, packets_recv) in data.items():
+            entity_id = "sensor.{}_interface".format(k)
+            kwargs = {"state" : bytes_sent, "attributes" : {"bytes_recv" : bytes_recv, "packets_sent" : packets_sent, 
+                    "bytes_sent" : bytes_sent , "packets_recv" : packets_recv, "friendly_name" : "{} Interface".format(k.capitalize())}}
+            batch[entity_id] = kwargs
+
+    def sample_process(self, nowTime, batch):
+        data = self.backend.process()
+        now = time.monotonic()
+
+        # cpu percent over the time since the last sample
+        last = self.process_last
+        self.process_last = (now, data["user"], data["system"])
+        if last is not None and now > last[0]:
+            user = round((data["user"] - last[1]) / (now - last[0]) * 100, 1)
+            system = round((data["system"] - last[2]) / (now - last[0]) * 100, 1)
+        else:
+            user = system = 0.0
+
+        entity_id = "sensor.appdaemon_memory"
+        kwargs = {"state" : data["rss"], "attributes" : {"rss" : data["rss"], "uss" : data["uss"], "vms" : data["vms"], "friendly_name" : "AppDaemon Memory"}}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.appdaemon_cpu"
+        kwargs = {"state" : round(user + system, 1), "attributes" : {"user" : user, "system" : system, "friendly_name" : "AppDaemon CPU"}}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.appdaemon_threads"
+        kwargs = {"state" : data["threads"], "attributes" : {"friendly_name" : "AppDaemon Threads"}}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.appdaemon_open_files"
+        kwargs = {"state" : data["fds"], "attributes" : {"friendly_name" : "AppDaemon Open Files"}}
+        batch[entity_id] = kwargs
+
+        entity_id = "sensor.appdaemon_context_switches"
+        kwargs = {"state" : data["voluntary"] + data["involuntary"], "attributes" : {"voluntary" : data["voluntary"], "involuntary" : data["involuntary"],
+            "friendly_name" : "AppDaemon Context Switches"}}
+        batch[entity_id] = kwargs
+
+        # gc pauses since the last sample
+        pause, self.gc_pause = self.gc_pause, 0.0
+        max_pause, self.gc_max_pause = self.gc_max_pause, 0.0
+        attributes = {"generation{}".format(i) : count for i, count in enumerate(gc.get_count())}
+        attributes.update({"collections{}".format(i) : stats["collections"] for i, stats in enumerate(gc.get_stats())})
+        attributes.update({"max_pause" : round(max_pause * 1000, 3), "friendly_name" : "AppDaemon GC Pause"})
+        entity_id = "sensor.appdaemon_gc"
+        kwargs = {"state" : round(pause * 1000, 3), "attributes" : attributes}
+        batch[entity_id] = kwargs
+
+    def gc_callback(self, phase, info):
+        if phase == "start":
+            self.gc_started = time.perf_counter()
+
+        elif self.gc_started is not None:
+            pause = time.perf_counter() - self.gc_started
+            self.gc_started = None
+            self.gc_pause += pause
+            self.gc_max_pause = max(self.gc_max_pause, pause)
+
+    def close(self):
+        self.backend.close()
+        if self.gc_callback in gc.callbacks:
+            gc.callbacks.remove(self.gc_callback)
 
 class HwstatsPlugin(PluginBase):
     def __init__(self, ad: AppDaemon, name, args):
@@ -34,19 +661,106 @@ class HwstatsPlugin(PluginBase):
         self.hw_sensors = self.config.get('sensors', [])
         self.hw_update_interval = self.config.get('update_interval', 1.0)
 
+        # events are only sent when a sensor changes beyond its deadband, or it has been silent for heartbeat seconds
+        self.hw_deadbands = self.config.get('deadband', {})
+        self.hw_heartbeat = self.config.get('heartbeat', None)
+        self.hw_last_sent = {}
+
         self.loop = self.AD.loop # get AD loop
         self.state_Lock = asyncio.Lock(loop = self.loop)
-        self.booted = datetime.fromtimestamp(psutil.boot_time()).replace(microsecond=0) #get system up time
+
+        # the sensors are read with psutil, or with the faster /proc and /sys readers on Linux if backend is proc
+        backend = self.config.get('backend', 'psutil')
+        if backend not in ('psutil', 'proc') or (backend == 'proc' and not sys.platform.startswith('linux')):
+            self.logger.warning("Backend %r is not available on this platform, so using psutil", backend)
+        self.hw_host = HostSampler(backend, "process" in self.hw_sensors)
+
+        # the event loop lag is measured by a probe task, and if the callbacks group is set, slow callbacks by timing the loop's handles
+        self.hw_loop_probe_interval = self.config.get('loop_probe_interval', 0.25)
+        self.hw_slow_callback = self.config.get('slow_callback_duration', 0.1)
+        self.hw_loop_warning = self.config.get('loop_warning', None)
+        self.hw_lag = LagHistogram()
+        self.hw_loop_tasks = 0
+        self.hw_loop_probe = None
+        self.hw_slow_callbacks = collections.deque(maxlen = 100)
+        if "callbacks" in self.hw_sensors and self.hw_slow_callback:
+            CallbackTimer.watch(self, self.loop, self.timed_callback)
+
+        # each sensor group is sampled at its own interval, or only once if set to once
+        samplers = {
+            "datetime" : self.sample_datetime,
+            "loop" : self.sample_loop,
+            "callbacks" : self.sample_callbacks
+        }
+        samplers.update(self.hw_host.samplers())
+        intervals = self.config.get('intervals', {})
+        self.hw_samplers = {}
+        for group, sampler in samplers.items():
+            if group != "datetime" and group not in self.hw_sensors:
+                continue
+
+            interval = intervals.get(group, self.hw_update_interval)
+            if interval != "once" and (not isinstance(interval, (int, float)) or interval <= 0):
+                self.logger.warning("Interval %r for Sensor %r is not valid, so using %s", interval, group, self.hw_update_interval)
+                interval = self.hw_update_interval
+            self.hw_samplers[group] = (sampler, interval)
+
+        # the timing wheel ticks at the longest period all intervals are multiples of, and all samplers due on a tick share one executor hop.
+        # A tick far below the shortest interval would mostly wake up for nothing, so then the shortest interval is used instead
+        periods = [x[1] for x in self.hw_samplers.values() if x[1] != "once"] or [self.hw_update_interval]
+        tick = common_tick(periods)
+        if tick < min(periods) / 10:
+            tick = min(periods)
+        self.hw_tick = self.config.get('tick', tick)
+        self.hw_wheel = TimingWheel()
+        for group, (sampler, interval) in self.hw_samplers.items():
+            if interval != "once":
+                ticks = max(1, round(interval / self.hw_tick))
+                if abs(ticks * self.hw_tick - interval) > 0.001:
+                    self.logger.warning("Interval %s of Sensor %r is not a multiple of the %ss tick, so it is sampled every %ss", interval, group, self.hw_tick, round(ticks * self.hw_tick, 3))
+                self.hw_wheel.schedule(group, ticks)
+
+        # opt-in rolling window aggregates of numeric sensors, sized for the largest window at the fastest tick
+        self.hw_windows = sorted(self.config.get('windows', []))
+        self.hw_window_sensors = self.config.get('window_sensors', None) # all numeric sensors, if not set
+        self.hw_window_percentiles = self.config.get('window_percentiles', [50, 95])
+        self.hw_window_capacity = int(self.hw_windows[-1] / self.hw_tick) + 2 if self.hw_windows else 0
+        self.hw_window_period = 0
+        max_samples = self.config.get('window_max_samples', 4096)
+        if self.hw_window_capacity > max_samples: # downsampled, so the largest window still spans its full length
+            self.hw_window_capacity = max_samples
+            self.hw_window_period = self.hw_windows[-1] / (max_samples - 2)
+            self.logger.info("Window of %ss needs more than %s samples, so one sample every %.3fs is kept", self.hw_windows[-1], max_samples, self.hw_window_period)
+        self.hw_window_buffers = {}
+
+        # collector mode, where agent.py sends the samples of other hosts as frames over UDP or a Unix socket
+        self.hw_collector = self.config.get('collector', None)
+        self.hw_collector_transport = None
+        self.hw_collector_path = None
+        self.hw_collector_frames = {} # latest frame per host, applied on the next tick
+        self.hw_collector_errors = 0
+        self.hw_agents = {}
 
         self.hwstats_metadata = {
                                         "version": "1.0",
-                                        "sensors": self.hw_sensors                                      
+                                        "sensors": self.hw_sensors,
+                                        "intervals": {x: y[1] for x, y in self.hw_samplers.items()}
                                     }
 
     def stop(self):
         self.logger.debug("stop() called for %s", self.name)
         self.logger.info("Stopping Hardware Stats Plugin")
         self.stopping = True
+        if self.getHWStats != None and not self.getHWStats.done(): # the sensors are still being read, so closed once done
+            self.getHWStats.add_done_callback(lambda future: self.hw_host.close())
+        else:
+            self.hw_host.close()
+        CallbackTimer.unwatch(self)
+        if self.hw_collector_transport is not None:
+            self.hw_collector_transport.close()
+            self.hw_collector_transport = None
+        if self.hw_collector_path is not None and os.path.exists(self.hw_collector_path):
+            os.unlink(self.hw_collector_path)
 
     #
     # Get initial state
@@ -74,23 +788,57 @@ class HwstatsPlugin(PluginBase):
 
     async def get_updates(self):
         first_time = True
+        pending = list(self.hw_samplers) # every sensor group is sampled at start
+        started = time.monotonic()
+
+        if "loop" in self.hw_samplers and self.hw_loop_probe == None:
+            self.hw_loop_probe = asyncio.ensure_future(self.probe_loop(), loop = self.loop)
+
+        if self.hw_collector is not None and self.hw_collector_transport == None:
+            await self.start_collector()
 
         while not self.stopping: 
-            if (self.getHWStats == None or self.getHWStats.cancelled()) and first_time:
-                self.getHWStats = asyncio.ensure_future(utils.run_in_executor(self, self.get_sensor_states, first_time), loop = self.loop)
+            if self.getHWStats != None and self.getHWStats.done():
+                batch = self.getHWStats.result()
+                self.getHWStats = None
+
+                if self.hw_windows != []:
+                    self.add_window_samples(batch)
+
+                if first_time: #meaning the plugin running first time
+                    self.state.update(batch) # AD isn't ready for events yet, so the state is sent when the plugin starts
+                    self.hw_last_sent.update(dict.fromkeys(batch, time.monotonic()))
+                    state = await self.get_complete_state()
+                    meta = await self.get_metadata()
+                    await self.AD.plugins.notify_plugin_started(self.name, self.namespace, meta, state, first_time)
+                    first_time = False
+                    self.logger.info("Hardware Stats Plugin initialization complete")
 
-            state = await self.get_complete_state()
-            meta = await self.get_metadata()
+                else:
+                    await self.apply_sensor_states(batch)
 
-            if self.getHWStats != None and self.getHWStats.done() and first_time: #meaning the plugin running first time
-                await self.AD.plugins.notify_plugin_started(self.name, self.namespace, meta, state, first_time)
-                first_time = False
-                self.logger.info("Hardware Stats Plugin initialization complete")
+            if self.hw_collector_transport != None and not first_time:
+                try:
+                    await self.apply_collector_frames()
+                except:
+                    self.logger.warning("There was an error while applying the frames from the agents")
+                    self.logger.debug("There was an error while applying the frames from the agents, with Traceback: %s", traceback.format_exc())
 
-            elif self.getHWStats != None and self.getHWStats.done():
-                self.getHWStats = asyncio.ensure_future(utils.run_in_executor(self, self.get_sensor_states, first_time), loop = self.loop)
+            if self.getHWStats == None and pending != [] and not self.stopping: # stop() may have run while the states were being applied
+                self.getHWStats = asyncio.ensure_future(utils.run_in_executor(self, self.get_sensor_states, pending), loop = self.loop)
+                pending = []
 
-            await asyncio.sleep(self.hw_update_interval)
+            delay = started + (self.hw_wheel.tick + 1) * self.hw_tick - time.monotonic()
+            if self.getHWStats != None and not self.getHWStats.done() and delay > 0:
+                await asyncio.wait([self.getHWStats], timeout = delay) # so the readings are applied as soon as they are in
+                continue
+
+            await asyncio.sleep(max(0, delay))
+
+            for group in self.hw_wheel.advance():
+                if group not in pending: # else still waiting for the last hop to finish
+                    pending.append(group)
+                self.hw_wheel.schedule(group, round(self.hw_samplers[group][1] / self.hw_tick))
 
     #
     # Set State
@@ -99,110 +847,269 @@ class HwstatsPlugin(PluginBase):
     def get_namespace(self):
         return self.namespace
     
-    def get_sensor_states(self, first_time):
+    def get_sensor_states(self, groups):
+        """Samples the sensor groups in the executor, and returns the readings as one batch for the loop"""
         nowTime = datetime.now().replace(microsecond=0)
+        batch = {}
+
+        for group in groups:
+            sampler = self.hw_samplers[group][0]
+            try:
+                sampler(nowTime, batch)
+            except:
+                self.logger.warning("There was an error while sampling Sensor %s", group)
+                self.logger.debug("There was an error while sampling Sensor %s, with Traceback: %s", group, traceback.format_exc())
 
+        return batch
+
+    def sample_datetime(self, nowTime, batch):
         entity_id = "sensor.datetime"
         state = nowTime.replace(microsecond = 0, second = 0).strftime("%H:%M")
         nowD = nowTime.date().strftime("%d/%m/%Y")
         nowday = list(calendar.day_name)[nowTime.weekday()]
         kwargs = {"state" : state, "attributes" : {"date" : nowD, "day" : nowday, "friendly_name" : "Date Time"}}
-        if not first_time:
-            self.loop.create_task(self.state_update(entity_id, kwargs))
-
-        # get CPU sensors
-        if "cpu" in self.hw_sensors:
-            entity_id = "sensor.cpu_freq"
-            data = psutil.cpu_freq()
-            kwargs = {"state" : data.current, "attributes" : {"min" : data.min, "max" : data.max, "friendly_name" : "CPU Frequency"}}
-            if not first_time:
-                self.loop.create_task(self.state_update(entity_id, kwargs))
-
-            entity_id = "sensor.cpu_count"
-            data = psutil.cpu_count()
-            kwargs = {"state" : data, "attributes" : {"friendly_name" : "CPU Count"}}
-            if not first_time:
-                self.loop.create_task(self.state_update(entity_id, kwargs))
-
-        if "memory" in self.hw_sensors:
-            entity_id = "sensor.virtual_memory"
-            data = psutil.virtual_memory()
-            kwargs = {"state" : data.percent, "attributes" : {"used" : data.used, "free" : data.free, "total" : data.total, "available" : data.available, 
-                "active" : data.active, "inactive" : data.inactive, "buffers" : data.buffers, "cached" : data.cached, "shared" : data.shared, "friendly_name" : "Virtual Memory"}}
-            if not first_time:
-                self.loop.create_task(self.state_update(entity_id, kwargs))
-
-            entity_id = "sensor.swap_memory"
-            data = psutil.swap_memory()
-            kwargs = {"state" : data.percent, "attributes" : {"used" : data.used, "free" : data.free, "total" : data.total, "friendly_name" : "Swap Memory"}}
-            if not first_time:
-                self.loop.create_task(self.state_update(entity_id, kwargs))
-
-        if "temperature" in self.hw_sensors:
-            data = psutil.sensors_temperatures()
-            for k, v in data.items():
-                entity_id = "sensor.{}_temperature".format(k)
-                sensorData = v[0]
-                kwargs = {"state" : sensorData.current, "attributes" : {"hgih" : sensorData.high, "critical" : sensorData.critical, "friendly_name" : "{} Temperature".format(k.capitalize())}}
-                if not first_time:
-                    self.loop.create_task(self.state_update(entity_id, kwargs))
-
-        if "uptime" in self.hw_sensors:
-            entity_id = "sensor.hardware_uptime"
-            uptime = nowTime - self.booted
-            state = str(uptime)
-            days = uptime.days
-            seconds = uptime.seconds
-            kwargs = {"state" : state, "attributes" : {"days" : days, "seconds" : seconds, "friendly_name" : "Hardware Up Time"}}
-            if not first_time:
-                self.loop.create_task(self.state_update(entity_id, kwargs))
-
-        if "network" in self.hw_sensors:
-            data = psutil.net_io_counters(pernic=True)
-            for k, v in data.items():
-                entity_id = "sensor.{}_interface".format(k)
-                sensorData = v
-                kwargs = {"state" : sensorData.bytes_sent, "attributes" : {"bytes_recv" : sensorData.bytes_recv, "packets_sent" : sensorData.packets_sent, 
-                        "bytes_sent" : sensorData.bytes_sent , "packets_recv" : sensorData.packets_recv, "friendly_name" : "{} Interface".format(k.capitalize())}}
-                if not first_time:
-                    self.loop.create_task(self.state_update(entity_id, kwargs))
+        batch[entity_id] = kwargs
 
-    async def state_update(self, entity_id, kwargs):
-        self.logger.debug("Updating State for Entity_ID %s, with %s", entity_id, kwargs)
+    def sample_loop(self, nowTime, batch):
+        lag, self.hw_lag = self.hw_lag, LagHistogram() # lags since the last sample
 
-        if entity_id in self.state:
-            old_state = self.state[entity_id]
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
 
-        else:
-            # Its a new state entry
-            self.state[entity_id] = dict()
-            old_state = {}
-            old_state['attributes'] = {}
+        entity_id = "sensor.appdaemon_loop_lag"
+        kwargs = {"state" : ms(lag.percentile(99)), "attributes" : {"p50" : ms(lag.percentile(50)), "p99" : ms(lag.percentile(99)), "max" : ms(lag.max),
+            "samples" : lag.count, "friendly_name" : "AppDaemon Loop Lag"}}
+        batch[entity_id] = kwargs
 
-        new_state = copy.deepcopy(old_state)
+        entity_id = "sensor.appdaemon_tasks"
+        kwargs = {"state" : self.hw_loop_tasks, "attributes" : {"friendly_name" : "AppDaemon Pending Tasks"}}
+        batch[entity_id] = kwargs
 
-        if 'attributes' not in new_state: #just to ensure
-            new_state['attributes'] = {}
+        # the executor used by run_in_executor, and the worker threads running the apps' callbacks
+        executor = getattr(self.AD, "executor", None)
+        queue = getattr(executor, "_work_queue", None)
+        workers = len(getattr(executor, "_threads", ()))
+        idle = getattr(getattr(executor, "_idle_semaphore", None), "_value", 0)
+        threads = getattr(getattr(self.AD, "threading", None), "threads", {})
+        worker_queue = sum(x["queue"].qsize() for x in list(threads.values()) if "queue" in x)
+        entity_id = "sensor.appdaemon_executor"
+        kwargs = {"state" : queue.qsize() if queue is not None else None, "attributes" : {"active_workers" : max(0, workers - idle), "workers" : workers,
+            "max_workers" : getattr(executor, "_max_workers", None), "worker_threads" : len(threads), "worker_queue" : worker_queue,
+            "friendly_name" : "AppDaemon Executor"}}
+        batch[entity_id] = kwargs
 
-        if 'state' in kwargs:
-            new_state['state'] = kwargs['state']
-            del kwargs['state']
+    def sample_callbacks(self, nowTime, batch):
+        def ms(value):
+            return round(value * 1000, 3) if value is not None else None
 
-        if 'attributes' in kwargs:
-            new_state['attributes'].update(kwargs['attributes'])
+        slow = []
+        while self.hw_slow_callbacks:
+            slow.append(self.hw_slow_callbacks.popleft())
+        slowest = sorted(slow, key = lambda x: x[1], reverse = True)[:5]
+        entity_id = "sensor.appdaemon_slow_callbacks"
+        kwargs = {"state" : len(slow), "attributes" : {"slowest" : ["{} ({}ms)".format(x[0], ms(x[1])) for x in slowest],
+            "threshold" : ms(self.hw_slow_callback), "friendly_name" : "AppDaemon Slow Callbacks"}}
+        batch[entity_id] = kwargs
 
-        else:
-            new_state['attributes'].update(kwargs)
+    async def probe_loop(self):
+        interval = self.hw_loop_probe_interval
+        all_tasks = getattr(asyncio, "all_tasks", None) or asyncio.Task.all_tasks
 
+        while not self.stopping:
+            expected = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - expected)
+            self.hw_lag.record(lag)
+            self.hw_loop_tasks = len([x for x in all_tasks(self.loop) if not x.done()])
+
+            if self.hw_loop_warning and lag >= self.hw_loop_warning:
+                self.logger.warning("The event loop was blocked for %.3fs", lag)
+
+    def timed_callback(self, handle, duration):
+        if duration < self.hw_slow_callback:
+            return
+
+        name = callback_name(handle._callback)
+        self.hw_slow_callbacks.append((name, duration))
+
+        if self.hw_loop_warning and duration >= self.hw_loop_warning:
+            self.logger.warning("Callback %s blocked the event loop for %.3fs", name, duration)
+
+    async def start_collector(self):
+        listen = self.hw_collector.get("listen", "udp://127.0.0.1:9955") # only local agents, unless set
+        try:
+            if listen.startswith("unix://"):
+                path = listen[len("unix://"):]
+                if os.path.exists(path): # left over from the last run
+                    os.unlink(path)
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.bind(path)
+                self.hw_collector_path = path
+                transport, _ = await self.loop.create_datagram_endpoint(lambda: CollectorProtocol(self), sock = sock)
+
+            else:
+                host, port = listen[len("udp://"):].rsplit(":", 1) if listen.startswith("udp://") else listen.rsplit(":", 1)
+                transport, _ = await self.loop.create_datagram_endpoint(lambda: CollectorProtocol(self), local_addr = (host, int(port)))
+
+            self.hw_collector_transport = transport
+            self.logger.info("Collecting Hardware Stats from agents on %s", listen)
+
+        except (OSError, ValueError) as e:
+            self.logger.critical("Could not listen for Hardware Stats agents on %s, as %s", listen, e)
+            self.logger.debug("Could not listen for Hardware Stats agents on %s, with Traceback: %s", listen, traceback.format_exc())
+
+    def collector_received(self, data, addr):
+        try:
+            frame = decode_frame(data)
+            check_frame(frame)
+            host = frame["host"]
+            sensors = frame["sensors"]
+        except Exception as e:
+            self.hw_collector_errors += 1
+            self.logger.debug("Dropping an invalid frame from %s, as %s", addr, e)
+            return
+
+        hosts = self.hw_collector.get("hosts")
+        if hosts is not None and host not in hosts:
+            self.logger.debug("Dropping a frame from Host %s, as it is not in the collector's hosts", host)
+            return
+
+        agent = self.hw_agents.get(host)
+        if agent is None:
+            agent = self.hw_agents[host] = {"prefix": re.sub(r'[^a-z0-9_]', '_', host.lower()), "seq": None, "lost": 0, "stale": False, "entities": set()}
+            self.logger.info("Collecting Hardware Stats from Host %s", host)
+
+        # UDP can lose or reorder frames, so late frames are dropped, and gaps counted
+        seq = frame.get("seq", 0)
+        if agent["seq"] is not None and seq != 0:
+            if seq <= agent["seq"]:
+                return
+            agent["lost"] += seq - agent["seq"] - 1
+        agent["seq"] = seq
+        agent["interval"] = frame.get("interval")
+        agent["last_seen"] = time.monotonic()
+        self.hw_collector_frames[host] = sensors # only the latest frame of a host is applied on each tick
+
+    async def apply_collector_frames(self):
+        frames, self.hw_collector_frames = self.hw_collector_frames, {}
+        now = time.monotonic()
+        batch = {}
+
+        for host, sensors in frames.items():
+            agent = self.hw_agents[host]
+            try:
+                readings = {}
+                for entity_id, (state, attributes) in sensors.items():
+                    domain, object_id = entity_id.split(".", 1)
+                    attributes["friendly_name"] = "{} {}".format(host, attributes.get("friendly_name", object_id))
+                    readings["{}.{}_{}".format(domain, agent["prefix"], object_id)] = {"state" : state, "attributes" : attributes}
+            except Exception:
+                self.hw_collector_errors += 1
+                self.logger.warning("Dropping a frame from Host %s, as it could not be applied", host)
+                self.logger.debug("Dropping a frame from Host %s, with Traceback: %s", host, traceback.format_exc())
+                continue
+
+            batch.update(readings)
+            agent["entities"].update(readings)
+
+            agent["stale"] = False
+            entity_id = "sensor.{}_agent".format(agent["prefix"])
+            batch[entity_id] = {"state" : "online", "attributes" : {"host" : host, "interval" : agent["interval"], "lost" : agent["lost"],
+                "friendly_name" : "{} Agent".format(host)}}
+
+        # hosts silent for stale_after seconds, or 3 of their intervals, are marked as such
+        for host, agent in self.hw_agents.items():
+            stale_after = self.hw_collector.get("stale_after") or 3 * (agent["interval"] or self.hw_update_interval)
+            if agent["stale"] or now - agent["last_seen"] < stale_after:
+                continue
+
+            agent["stale"] = True
+            self.logger.warning("No Hardware Stats from Host %s for %.0fs, so marking it as stale", host, now - agent["last_seen"])
+            for entity_id in agent["entities"]:
+                batch[entity_id] = {"state" : "unavailable", "attributes" : self.state.get(entity_id, {}).get("attributes", {})}
+
+            entity_id = "sensor.{}_agent".format(agent["prefix"])
+            batch[entity_id] = {"state" : "stale", "attributes" : self.state.get(entity_id, {}).get("attributes", {})}
+
+        # invalid frames can't be told apart by host, so they are counted on the collector as a whole
+        online = [x for x, y in self.hw_agents.items() if not y["stale"]]
+        batch["sensor.hwstats_collector"] = {"state" : len(online), "attributes" : {"hosts" : sorted(online),
+            "stale" : sorted(x for x, y in self.hw_agents.items() if y["stale"]), "errors" : self.hw_collector_errors,
+            "friendly_name" : "Hardware Stats Collector"}}
+
+        if batch != {}:
+            if self.hw_windows != []:
+                self.add_window_samples(batch)
+            await self.apply_sensor_states(batch)
+
+    def add_window_samples(self, batch):
+        now = time.monotonic()
+        for entity_id, kwargs in batch.items():
+            value = kwargs.get("state")
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if self.hw_window_sensors is not None and entity_id not in self.hw_window_sensors:
+                continue
+
+            buffer = self.hw_window_buffers.get(entity_id)
+            if buffer is None:
+                buffer = self.hw_window_buffers[entity_id] = RollingWindows(self.hw_windows, self.hw_window_capacity, self.hw_window_period)
+            buffer.add(now, value)
+
+            attributes = kwargs["attributes"]
+            for w, window in enumerate(self.hw_windows):
+                name = window_name(window)
+                for stat, result in buffer.stats(w, self.hw_window_percentiles).items():
+                    attributes["{}_{}".format(stat, name)] = round(result, 3)
+
+    async def state_update(self, entity_id, kwargs):
+        self.logger.debug("Updating State for Entity_ID %s, with %s", entity_id, kwargs)
+
+        old_state = self.state.get(entity_id, {})
+        attributes = dict(old_state.get('attributes', {}))
+        attributes.update(kwargs.get('attributes', {x: y for x, y in kwargs.items() if x != 'state'}))
+        await self.apply_sensor_states({entity_id: {'state': kwargs.get('state', old_state.get('state')), 'attributes': attributes}})
+
+    async def apply_sensor_states(self, batch):
         try:
             last_changed = utils.dt_to_str((await self.AD.sched.get_now()).replace(microsecond=0), self.AD.tz) #possible AD isn't ready at this point
         except:
             last_changed = None
-        
-        new_state['last_changed'] = last_changed
-        data = {'event_type': 'state_changed', 'data': {'entity_id': entity_id, 'new_state': new_state, 'old_state': old_state}}
 
-        await self.AD.events.process_event(self.namespace, data)
-        
-        self.state[entity_id].update(new_state)
-        return
+        for entity_id, kwargs in batch.items():
+            old_state = self.state.get(entity_id, {'attributes': {}})
+
+            # the attributes are fresh from the sampler, and states are replaced rather than changed, so nothing needs copying
+            new_state = {'state': kwargs.get('state'), 'attributes': kwargs['attributes']}
+
+            if not self.sensor_changed(entity_id, new_state, old_state):
+                continue
+
+            new_state['last_changed'] = last_changed
+            data = {'event_type': 'state_changed', 'data': {'entity_id': entity_id, 'new_state': new_state, 'old_state': old_state}}
+
+            await self.AD.events.process_event(self.namespace, data)
+
+            self.state[entity_id] = new_state
+
+    def sensor_changed(self, entity_id, new_state, old_state):
+        deadband = self.hw_deadbands.get(entity_id, self.hw_deadbands.get('default', {}))
+        heartbeat = deadband.get('heartbeat', self.hw_heartbeat)
+        now = time.monotonic()
+
+        if entity_id not in self.hw_last_sent or (heartbeat and now - self.hw_last_sent[entity_id] >= heartbeat):
+            changed = True
+
+        else:
+            absolute = deadband.get('absolute', 0)
+            percent = deadband.get('percent', 0)
+            changed = exceeds_deadband(new_state.get('state'), old_state.get('state'), absolute, percent)
+
+            if not changed: # attributes are in various units, so only the percent deadband applies to them
+                old_attributes = old_state.get('attributes', {})
+                changed = any(exceeds_deadband(v, old_attributes.get(k), 0, percent) for k, v in new_state['attributes'].items())
+
+        if changed:
+            self.hw_last_sent[entity_id] = now
+
+        return changed
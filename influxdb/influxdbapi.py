@@ -95,6 +95,63 @@ class Influxdb(adbase.ADBase, adapi.ADAPI):
             )
             return None
 
+    @utils.sync_wrapper
+    async def write_points(self, points, **kwargs):
+        """Writes a batch of points to the Database in a single request.
+        This is a convenience function that allows an app to store many points at once,
+        instead of making a ``influx/write`` service call for each of them. The points
+        are handed to the plugin's writer as one batch, so the app thread is not blocked
+        per point.
+        Args:
+            points (list | dict | DataFrame): The points to be written. This can be either
+                a list of dictionaries each with ``measurement``, ``tags``, ``fields`` and ``time``,
+                columnar arrays as a dictionary with ``measurement``, ``time`` as a list, ``fields``
+                mapping each field to a list of values and ``tags`` mapping each tag to a value or list
+                of values, or a pandas DataFrame indexed by time.
+            **kwargs (optional): Zero or more keyword arguments.
+        Keyword Args:
+            bucket (str, optional): The bucket the data is to be written to. If not specifed, it
+                uses the default on set in the plugin
+            measurement (str, optional): The measurement to use for points that do not declare
+                one. This must be given when writing a DataFrame.
+            tag_columns (list, optional): The columns of a DataFrame which are to be stored as tags.
+            callback (callable, optional): If wanting to write a large amount of data, it is better
+                to pass a function, which will be responsible of receiving the result of the write.
+                The signature of this function follows that of a scheduler call.
+            namespace (str, optional): Namespace to use for the call, which the database is functioning. See the section on
+                `namespaces <APPGUIDE.html#namespaces>`__ for a detailed description.
+                In most cases it is safe to ignore this parameter.
+        Returns:
+            ``True`` if the points were written, ``False`` otherwise. If a callback is
+            given, the result is passed to the callback instead.
+
+        Examples:
+            Write points computed within the app.
+            >>> self.write_points([{"measurement": "power", "tags": {"site": "home"},
+                "fields": {"watts": 120.5}, "time": now}, {"measurement": "power",
+                "tags": {"site": "home"}, "fields": {"watts": 118.0}, "time": later}])
+            Write columnar arrays to the bucket sensors.
+            >>> self.write_points({"measurement": "power", "time": [now, later],
+                "fields": {"watts": [120.5, 118.0]}, "tags": {"site": "home"}}, bucket="sensors")
+        """
+
+        namespace = self._get_namespace(**kwargs)
+        plugin = await self.AD.plugins.get_plugin_object(namespace)
+
+        if hasattr(plugin, "write_points"):
+            callback = kwargs.pop("callback", None)
+            if callback is not None and callable(callback):
+                self.create_task(plugin.write_points(points, **kwargs), callback)
+
+            else:
+                return await plugin.write_points(points, **kwargs)
+
+        else:
+            self.logger.warning(
+                "Wrong Namespace selected, as %s has no database plugin attached to it", namespace,
+            )
+            return None
+
     @utils.sync_wrapper
     async def get_write_api(self, **kwargs):
         """Gets access to the Database's write api object.
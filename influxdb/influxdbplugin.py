@@ -54,6 +54,7 @@ class InfluxdbPlugin(PluginBase):
         self._connection_pool_maxsize = int(self.config.get("connection_pool_maxsize", 100))
         self._verify_ssl = self.config.get("verify_ssl", False)
         self._ssl_ca_cert = self.config.get("ssl_ca_cert")
+        self._write_timeout = self.config.get("write_timeout", 5)
 
         if self._connection_pool_maxsize < 5:
             self.logger.warning(
@@ -281,7 +282,12 @@ class InfluxdbPlugin(PluginBase):
             raise ValueError("Bucket must be given to execute the service call %s", service)
 
         if service == "write":
-            asyncio.create_task(self.database_write(bucket, **kwargs))
+            if "points" in kwargs:
+                points = kwargs.pop("points")
+                asyncio.create_task(self.write_points(points, bucket=bucket, **kwargs))
+
+            else:
+                asyncio.create_task(self.database_write(bucket, **kwargs))
 
         elif service == "read":
             res = await self.database_read(bucket, **kwargs)
@@ -314,8 +320,10 @@ class InfluxdbPlugin(PluginBase):
 
             write_data["time"] = ts
             await asyncio.wait_for(
-                utils.run_in_executor(self, self._write_api.write, bucket, self._org, write_data), timeout=5
+                utils.run_in_executor(self, self._write_api.write, bucket, self._org, write_data),
+                timeout=self._write_timeout,
             )
+            executed = True
 
         except Exception as e:
             self.logger.error("-" * 60)
@@ -327,6 +335,98 @@ class InfluxdbPlugin(PluginBase):
 
         return executed
 
+    async def write_points(self, points, **kwargs):
+        """Used to write a batch of points to the database in a single request"""
+
+        executed = False
+        bucket = kwargs.get("bucket", self._bucket)
+        measurement = kwargs.get("measurement")
+
+        try:
+            if bucket is None:
+                raise ValueError("The required bucket to be written to must be given")
+
+            write_kwargs = {}
+            if hasattr(points, "columns") and hasattr(points, "index"):
+                # its a DataFrame, which the writer serializes natively
+                if measurement is None:
+                    raise ValueError("The measurement must be given when writing a DataFrame")
+
+                write_kwargs["data_frame_measurement_name"] = measurement
+                write_kwargs["data_frame_tag_columns"] = kwargs.get("tag_columns", [])
+                records = points
+
+            else:
+                records = self.get_point_records(points, measurement, await self.AD.sched.get_now())
+
+            if len(records) == 0:
+                return executed
+
+            await asyncio.wait_for(
+                utils.run_in_executor(self, self._write_api.write, bucket, self._org, records, **write_kwargs),
+                timeout=self._write_timeout,
+            )
+            executed = True
+
+        except Exception as e:
+            self.logger.error("-" * 60)
+            self.logger.error("Could not execute database write of points. %s %s", bucket, kwargs)
+            self.logger.error("-" * 60)
+            self.logger.error(e)
+            self.logger.debug(traceback.format_exc())
+            self.logger.error("-" * 60)
+
+        return executed
+
+    def get_point_records(self, points, measurement, now):
+        """Used to convert a list of points or columnar arrays, into the writer's records"""
+
+        records = []
+
+        if isinstance(points, dict):
+            # columnar arrays, with a sequence of values for each field
+            fields = points.get("fields", {})
+            tags = points.get("tags", {})
+            times = points.get("time")
+            measurement = points.get("measurement", measurement)
+            size = len(times) if times is not None else max([len(values) for values in fields.values()], default=0)
+
+            for column, values in fields.items():
+                if len(values) != size:
+                    raise ValueError(f"The field {column} does not have the same length as the other columns")
+
+            for i in range(size):
+                record = {"measurement": measurement, "fields": {}, "tags": {}}
+                record["time"] = times[i] if times is not None else now
+
+                for column, values in fields.items():
+                    if values[i] is not None:
+                        record["fields"][column] = values[i]
+
+                for tag, value in tags.items():
+                    record["tags"][tag] = value[i] if isinstance(value, (list, tuple)) else value
+
+                records.append(record)
+
+        elif isinstance(points, (list, tuple)):
+            for point in points:
+                record = dict(point)
+                record.setdefault("measurement", measurement)
+
+                if "time" not in record:
+                    record["time"] = record.pop("timestamp", now)
+
+                records.append(record)
+
+        else:
+            raise ValueError("Invalid type for points, it must be a list of dicts, columnar arrays or a DataFrame")
+
+        for record in records:
+            if record["measurement"] is None:
+                raise ValueError("The measurement must be given for every point to be written")
+
+        return records
+
     async def database_read(self, bucket, **kwargs):
         """Used to fetch data from a database"""
 